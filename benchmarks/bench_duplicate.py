@@ -0,0 +1,61 @@
+"""
+Benchmark of duplicate resolution on a synthetic feed.
+Usage: python benchmarks/bench_duplicate.py [chapters] [groups]
+"""
+
+import sys
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mangadex_dl import duplicate as dup
+from mangadex_dl.models import Chapter
+
+
+def make_feed(chapter_count, group_count):
+    """Every chapter number is uploaded by one to three groups."""
+    rng = random.Random(0)
+    chapters_list = []
+    number = 0
+
+    while len(chapters_list) < chapter_count:
+        number += 1
+        for group in rng.sample(range(group_count), rng.randint(1, 3)):
+            chapters_list.append(Chapter(id=f"chapter-{len(chapters_list)}",
+                                         manga_id="manga",
+                                         volume=str(number // 10 + 1),
+                                         chapter=str(number),
+                                         title="",
+                                         group_id=f"group-{group}",
+                                         group_name=f"Group {group}",
+                                         pages=20,
+                                         updated_at=None))
+    return chapters_list[:chapter_count]
+
+
+def resolve_manual(chapters_list, duplicates_list, scanlation_groups):
+    for group in scanlation_groups:
+        group["priority"] = str(int(group["id"].split("-")[1]) % 5 + 1)
+    return dup.resolve_scanlate_priority_function(chapters_list,
+                                                  duplicates_list,
+                                                  scanlation_groups)
+
+
+def main():
+    chapter_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    group_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+
+    for resolve in ("all", "one", "manual"):
+        chapters_list = make_feed(chapter_count, group_count)
+        start = time.perf_counter()
+        result = dup.resolve_duplicated_chapters(chapters_list, resolve,
+                                                 resolve_manual)
+        seconds = time.perf_counter() - start
+        print(f"{resolve:6}: {chapter_count} -> {len(result)} chapters "
+              f"in {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 __version__ = "1.8.0"
 __all__ = [
-    "instance", "utils", "archive", "download", "duplicate", "parse", "console", "gui"
+    "instance", "utils", "archive", "download", "download_async", "duplicate",
+    "library", "cache", "models", "progress", "parse", "console", "gui"
 ]
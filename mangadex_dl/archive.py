@@ -3,13 +3,27 @@ Mangadex-dl: archive.py
 Functions for archiving the manga directory.
 """
 
+import os
+import queue
 import shutil
+import time
+import struct
 import zipfile
+import threading
+import multiprocessing
+import concurrent.futures
 from pathlib import Path
+from collections import deque, Counter
 
 import pymupdf
 from natsort import natsorted
 
+from mangadex_dl import library
+from mangadex_dl import progress
+
+WORKERS = 0          # processes archiving chapters or volumes, 0 is one per CPU core
+PDF_COMPRESS = True  # deflate the streams and images of PDF archives again
+
 
 def init_archive_mode(args):
     """Archiving mode for specified paths"""
@@ -46,9 +60,20 @@ def init_archive_mode(args):
 
 
 def archive_manga(manga_dir: Path, archive_mode: str, is_keep: bool, ext: str,
-                  gui: dict = {}) -> None:
-
-    dir_list = _find_directories(manga_dir, archive_mode, ext)
+                  gui: dict = {}, chapter_dirs: list[Path] = None,
+                  index=None) -> None:
+    """
+    Archive the manga directory. If 'chapter_dirs' is given, only
+    the archives containing these chapters are made again. Without
+    'is_keep' the older chapters are gone, so these chapters are added
+    to existing ZIP archives, or a numbered PDF is made next to the old one.
+    Archives are recorded in the open library 'index' if given.
+    """
+    if chapter_dirs is None:
+        dir_list = _find_directories(manga_dir, archive_mode, ext)
+    else:
+        dir_list = _get_affected_directories(manga_dir, archive_mode,
+                                             chapter_dirs)
 
     dir_archived = 0
     dir_max = len(dir_list)
@@ -57,35 +82,384 @@ def archive_manga(manga_dir: Path, archive_mode: str, is_keep: bool, ext: str,
         print("Looks like there is nothing to archive.", end="", flush=True)
         return
 
-    for directory in dir_list:
-        _archive_directory(directory, ext, archive_mode, is_keep)
-        dir_archived += 1
-
-        if gui.get("set"):
-            gui["progress_chapter"].set(
-                (dir_archived/dir_max)*100)
-            gui["progress_chapter_text"].set(
-                f"[ {dir_archived} / {dir_max} ]")
+    is_own_index = index is None
+    if is_own_index:
+        index = library.open_index(manga_dir.parent)
+    is_update = chapter_dirs is not None and not is_keep
+
+    with progress.reporting(gui) as bus:
+        for directory, arc_name in _archive_directories(dir_list, ext,
+                                                        archive_mode,
+                                                        is_keep, is_update):
+            dir_archived += 1
+
+            if index:
+                index.add_archive(arc_name, directory, archive_mode, ext)
+
+            bus.put("archive", count=dir_archived, total=dir_max)
+
+    if index and is_own_index:
+        index.close()
+
+
+class ArchivePipeline:
+    """
+    Archives every chapter, or every volume once its last requested
+    chapter is downloaded, in a background thread while the download
+    goes on. Pass add() as the callback of download_chapters() and
+    call join() after it. A whole manga is archived in join().
+    close() stops the thread if the download fails.
+    Like archive_manga() with 'chapter_dirs', without 'is_keep' the
+    chapters are added to the archives made by earlier downloads.
+    """
+
+    def __init__(self, manga_dir: Path, requested_chapters: list,
+                 archive_mode: str, is_keep: bool, ext: str,
+                 gui: dict = {}):
+        self.manga_dir = manga_dir
+        self.archive_mode = archive_mode
+        self.is_keep = is_keep
+        self.ext = ext
+        self.gui = gui
+        self.error = None
+
+        # chapters left to download in each volume
+        self.volumes_left = Counter(chapter.volume_name
+                                    for chapter in requested_chapters)
+        self.volume_dirs = {}
+        self.chapter_dirs = []
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, chapter, directory_chapter: Path | None) -> None:
+        """A chapter is downloaded, its directory is None if it had no pages."""
+        if directory_chapter:
+            self.chapter_dirs.append(directory_chapter)
+
+        if self.archive_mode == "chapter":
+            if directory_chapter:
+                self.queue.put(directory_chapter)
+        elif self.archive_mode == "volume":
+            volume = chapter.volume_name
+            if directory_chapter:
+                self.volume_dirs[volume] = directory_chapter.parent
+            self.volumes_left[volume] -= 1
+            if self.volumes_left[volume] == 0 and volume in self.volume_dirs:
+                self.queue.put(self.volume_dirs.pop(volume))
+
+    def close(self) -> None:
+        """Wait for the queued archives and stop the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def join(self) -> None:
+        """Wait for the queued archives and raise the first error."""
+        self.close()
+        if self.error:
+            raise self.error
+        if self.archive_mode == "manga":
+            archive_manga(self.manga_dir, self.archive_mode, self.is_keep,
+                          self.ext, self.gui, chapter_dirs=self.chapter_dirs)
+
+    def _run(self) -> None:
+        index = library.open_index(self.manga_dir.parent)
+
+        with progress.reporting(self.gui) as bus:
+            while True:
+                directory = self.queue.get()
+                if directory is None:
+                    break
+                if self.error:
+                    continue
+                try:
+                    arc_name = _archive_directory(directory, self.ext,
+                                                  self.archive_mode,
+                                                  self.is_keep,
+                                                  not self.is_keep)
+                    if index:
+                        index.add_archive(arc_name, directory,
+                                          self.archive_mode, self.ext)
+                    bus.put("archived", name=arc_name.name)
+                except Exception as err:
+                    # the download goes on, join() raises the error
+                    self.error = err
+
+        if index:
+            index.close()
+
+
+class ZipStream:
+    """
+    Writes downloaded pages straight into ZIP/CBZ archives, laid out
+    as _zip_dir would archive the chapter directories, which are never
+    made on the disk. Pages come from the image workers in any order
+    and are written in page order, chapters in the order they were added.
+    An existing archive is appended to, its pages aren't downloaded again.
+    """
+
+    def __init__(self, manga_dir: Path, archive_mode: str, ext: str):
+        self.manga_dir = manga_dir
+        self.archive_mode = archive_mode
+        self.ext = ext
+        self.lock = threading.Lock()
+        self.archives = {}  # archive path -> open _ZipArchive
+        self.current = None
+        self.made = {}  # archive path -> archived directory
+        self.chapter_dirs = set()
+
+    def add_chapter(self, chapter, page_names: list[str]) -> "_ChapterPages":
+        """Return the writer of the chapter, its directory is not created."""
+        with self.lock:
+            directory = self._get_chapter_directory(chapter)
+            if self.archive_mode == "chapter":
+                arc_dir = directory
+            elif self.archive_mode == "volume":
+                arc_dir = directory.parent
+            else:
+                arc_dir = self.manga_dir
+            arc_name = _get_archive_name(arc_dir, self.ext)
+
+            pages = None
+            archive = self.archives.get(arc_name)
+            if archive:
+                pages = archive.add_chapter(directory, page_names)
+            if pages is None:
+                # a new archive or the old one was closed meanwhile
+                archive = _ZipArchive(arc_name, arc_dir)
+                self.archives[arc_name] = archive
+                self.made[arc_name] = arc_dir
+                pages = archive.add_chapter(directory, page_names)
+
+            # the previous volume or chapter has no more pages to come
+            if self.current and self.current is not archive:
+                self.current.release()
+            self.current = archive
+            return pages
+
+    def close(self) -> None:
+        """Close all archives and record them in the library index."""
+        with self.lock:
+            for archive in self.archives.values():
+                archive.close()
+            self.archives = {}
+
+        index = library.open_index(self.manga_dir.parent)
+        if index:
+            for arc_name, directory in self.made.items():
+                index.add_archive(arc_name, directory, self.archive_mode,
+                                  self.ext)
+            index.close()
+
+    def _get_chapter_directory(self, chapter) -> Path:
+        # same names as download._create_chapter_directory
+        directory = self.manga_dir / f"Volume {chapter.volume_name}" / \
+            f"Chapter {chapter.chapter_name}"
+        if directory in self.chapter_dirs:
+            for i in range(1, 100):
+                temp_path = Path(f"{directory} ({i})")
+                if temp_path not in self.chapter_dirs:
+                    directory = temp_path
+                    break
+        self.chapter_dirs.add(directory)
+        return directory
+
+
+class _ZipArchive:
+    """Open archive of ZipStream, chapters are written one by one."""
+
+    def __init__(self, arc_name: Path, directory: Path):
+        arc_name.parent.mkdir(parents=True, exist_ok=True)
+        self.zip_file = zipfile.ZipFile(arc_name,
+                                        mode="a" if arc_name.is_file() else "w",
+                                        compression=zipfile.ZIP_STORED,
+                                        allowZip64=True)
+        self.names = set(self.zip_file.namelist())
+        self.directory = directory
+        self.chapters = deque()  # chapters with pages left to write
+        self.is_current = True
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add_chapter(self, directory: Path, page_names: list[str]):
+        """Return the writer of the chapter or None if the archive is closed."""
+        with self.lock:
+            if self.closed:
+                return None
+            pages = _ChapterPages(self, directory, page_names)
+            self.chapters.append(pages)
+            self.is_current = True
+            # pages already in the archive are skipped right away
+            self.flush()
+            return pages
+
+    def get_name(self, path: Path) -> str:
+        return path.relative_to(self.directory).as_posix()
+
+    def write(self, name: str, data: bytes | None = None) -> None:
+        """Write a page or, without data, a directory entry."""
+        if name in self.names:
+            return
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        if data is None:
+            info.external_attr = 0o40755 << 16 | 0x10
         else:
-            print(f"\r  Archiving [{dir_archived:3}/{dir_max:3}]...", end="")
+            info.external_attr = 0o644 << 16
+        self.zip_file.writestr(info, data or b"")
+        self.names.add(name)
+
+    def flush(self) -> None:
+        """Write the pages that are next in order. Holds the lock."""
+        while self.chapters:
+            self.chapters[0].write_ready()
+            if not self.chapters[0].is_complete():
+                return
+            self.chapters.popleft()
+
+        if not self.is_current:
+            self.close_locked()
+
+    def release(self) -> None:
+        """No more chapters are added, close it once they are written."""
+        with self.lock:
+            self.is_current = False
+            if not self.chapters:
+                self.close_locked()
+
+    def close(self) -> None:
+        with self.lock:
+            self.close_locked()
+
+    def close_locked(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.zip_file.close()
+
+
+class _ChapterPages:
+    """
+    Reorder buffer of one chapter. put() is called by the image workers,
+    the pages wait until the previous ones and chapters are written.
+    """
+
+    def __init__(self, archive: _ZipArchive, directory: Path,
+                 page_names: list[str]):
+        self.archive = archive
+        self.directory = directory
+        self.page_names = [archive.get_name(directory / name)
+                           for name in page_names]
+        self.buffer = {}  # page number -> data or None if it failed
+        self.next_page = 1
+        self.is_started = False
+
+    def is_done(self, image_count: int) -> bool:
+        """The page is already in the archive."""
+        return self.page_names[image_count - 1] in self.archive.names
+
+    def get_size(self, image_count: int) -> int:
+        with self.archive.lock:
+            return self.archive.zip_file.getinfo(
+                self.page_names[image_count - 1]).file_size
+
+    def put(self, image_count: int, data: bytes | None) -> None:
+        with self.archive.lock:
+            if self.archive.closed:
+                return
+            self.buffer[image_count] = data
+            if self.archive.chapters and self.archive.chapters[0] is self:
+                self.archive.flush()
+
+    def write_ready(self) -> None:
+        if not self.is_started:
+            # directory entries of the chapter as _zip_dir writes them
+            self.is_started = True
+            parents = self.directory.relative_to(self.archive.directory).parts
+            for i in range(1, len(parents) + 1):
+                self.archive.write("/".join(parents[:i]) + "/")
+
+        while self.next_page <= len(self.page_names):
+            name = self.page_names[self.next_page - 1]
+            if self.next_page in self.buffer:
+                data = self.buffer.pop(self.next_page)
+                if data is not None:
+                    self.archive.write(name, data)
+            elif name not in self.archive.names:
+                return
+            self.next_page += 1
+
+    def is_complete(self) -> bool:
+        return self.next_page > len(self.page_names)
+
+
+def _archive_directories(dir_list: list[Path], ext: str, archive_mode: str,
+                         is_keep: bool, is_update: bool):
+    """
+    Yield (directory, archive) in the order of 'dir_list'.
+    Chapters and volumes are archived by a pool of WORKERS processes,
+    at most two directories per process are queued at a time.
+    """
+    workers = min(WORKERS or os.cpu_count() or 1, len(dir_list))
+    if workers == 1 or archive_mode == "manga":
+        for directory in dir_list:
+            yield directory, _archive_directory(directory, ext, archive_mode,
+                                                is_keep, is_update)
+        return
+
+    # forked processes would inherit the locks held by the download threads
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=context,
+            initializer=_init_worker, initargs=(PDF_COMPRESS,)) as pool:
+        pending = deque()
+        for directory in dir_list:
+            pending.append((directory, pool.submit(_archive_directory,
+                                                   directory, ext,
+                                                   archive_mode,
+                                                   is_keep, is_update)))
+            if len(pending) >= workers * 2:
+                directory, future = pending.popleft()
+                yield directory, future.result()
+
+        while pending:
+            directory, future = pending.popleft()
+            yield directory, future.result()
+
+
+def _init_worker(pdf_compress: bool) -> None:
+    # spawned processes import the module again with the defaults
+    global PDF_COMPRESS
+    PDF_COMPRESS = pdf_compress
 
 
 def _archive_directory(directory: Path, ext: str, archive_mode: str,
-                       is_keep: bool = True) -> None:
-    arc_name = directory.with_suffix(directory.suffix + f".{ext}")
+                       is_keep: bool = True, is_update: bool = False) -> Path:
+    arc_name = _get_archive_name(directory, ext)
+    is_update = is_update and archive_mode != "chapter"
 
     if ext == "pdf":
+        if is_update and arc_name.is_file():
+            arc_name = _get_free_name(arc_name)
         _pdf_dir(arc_name, directory, archive_mode)
     else:
-        _zip_dir(arc_name, directory)
+        _zip_dir(arc_name, directory, is_update)
 
     if not is_keep:
         shutil.rmtree(directory)
 
+    return arc_name
+
 
 def _pdf_dir(arc_name: str, directory: Path, archive_mode: str) -> None:
+    """
+    In manga mode every volume is made in a separate document and
+    appended to the file by an incremental save, so that only one
+    volume is kept in memory. Raises ValueError if there are no pages.
+    """
     doc = pymupdf.open()
     toc = []  # table of content
+    part_name = Path(f"{arc_name}.part")
 
     page_num = 1
 
@@ -93,15 +467,10 @@ def _pdf_dir(arc_name: str, directory: Path, archive_mode: str) -> None:
         nonlocal page_num
         toc.append([level, d.name, page_num])
         for filename in natsorted(d.glob("**/*")):
-            if not filename.is_file():
+            if not filename.is_file() or _is_service_file(filename):
                 continue
             page_num += 1
-            img = pymupdf.open(filename)
-            img_info = img[0].get_image_info()[0]
-            rect = pymupdf.Rect(0.0, 0.0, img_info["width"], img_info["height"])
-            img.close()
-            page = doc.new_page(width=rect.width, height=rect.height)
-            page.insert_image(rect, filename=filename)
+            _add_image_page(doc, filename.read_bytes())
 
     def volume2pdf(d: Path, level: int = 1) -> None:
         for c_dir in natsorted(d.glob("*")):
@@ -110,36 +479,230 @@ def _pdf_dir(arc_name: str, directory: Path, archive_mode: str) -> None:
             chapter2pdf(c_dir, level)
 
     def manga2pdf(d: Path) -> None:
+        nonlocal doc
         l = natsorted(d.glob("*"))
         for v_dir in l:
             if not v_dir.is_dir():
                 continue
+            toc_len = len(toc)
             if len(l) > 1:
                 toc.append([1, v_dir.name, page_num])
                 volume2pdf(v_dir, 2)
             else:
                 volume2pdf(v_dir, 1)
+            if not doc.page_count:
+                # nothing to append, the volume has no pages
+                del toc[toc_len:]
+                continue
+            _append_pdf(doc, part_name)
+            doc.close()
+            doc = pymupdf.open()
+
+    try:
+        if archive_mode == "chapter":
+            chapter2pdf(directory)
+        elif archive_mode == "volume":
+            volume2pdf(directory)
+        else:
+            manga2pdf(directory)
+
+        if page_num == 1:
+            doc.close()
+            raise ValueError(f"No pages to archive in '{directory}'")
+
+        if archive_mode == "manga":
+            doc.close()
+            doc = pymupdf.open(part_name)
+
+        doc.set_toc(toc)
+        doc.metadata["creator"] = "mangadex_dl"
+        doc.metadata["creationDate"] = pymupdf.get_pdf_now()
+        if archive_mode == "manga":
+            doc.saveIncr()
+            doc.close()
+            os.replace(part_name, arc_name)
+        else:
+            _save_pdf(doc, arc_name)
+            doc.close()
+    finally:
+        part_name.unlink(missing_ok=True)
 
-    if archive_mode == "chapter":
-        chapter2pdf(directory)
-    elif archive_mode == "volume":
-        volume2pdf(directory)
+
+def _save_pdf(doc, path: Path) -> None:
+    if PDF_COMPRESS:
+        doc.ez_save(path)
     else:
-        manga2pdf(directory)
+        doc.save(path)
 
-    doc.set_toc(toc)
-    doc.metadata["creator"] = "mangadex_dl"
-    doc.metadata["creationDate"] = pymupdf.get_pdf_now()
-    doc.ez_save(arc_name)
-    doc.close()
 
+def _append_pdf(doc, path: Path) -> None:
+    """
+    Append the pages to the PDF file with an incremental save,
+    the pages already in the file aren't loaded.
+    """
+    if not path.is_file():
+        _save_pdf(doc, path)
+        return
 
-def _zip_dir(arc_name: str, directory: Path) -> None:
-    with zipfile.ZipFile(arc_name, mode="w",
+    if PDF_COMPRESS:
+        # deflated here, an incremental save can't collect garbage
+        doc = pymupdf.open("pdf", doc.tobytes(garbage=3, deflate=True,
+                                                deflate_images=True))
+
+    pdf = pymupdf.open(path)
+    pdf.insert_pdf(doc)
+    pdf.saveIncr()
+    pdf.close()
+
+    if PDF_COMPRESS:
+        doc.close()
+
+
+def _add_image_page(doc, data: bytes) -> None:
+    """The image is read once, its size comes from the header."""
+    size = _get_image_size(data)
+    if size is None:
+        img = pymupdf.open(stream=data)
+        img_info = img[0].get_image_info()[0]
+        size = img_info["width"], img_info["height"]
+        img.close()
+
+    rect = pymupdf.Rect(0.0, 0.0, *size)
+    page = doc.new_page(width=rect.width, height=rect.height)
+    page.insert_image(rect, stream=data)
+
+
+def _get_image_size(data: bytes) -> tuple[int, int] | None:
+    """Width and height of a PNG, JPEG, GIF or WebP image, or None."""
+    try:
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return struct.unpack(">II", data[16:24])
+        if data.startswith(b"\xff\xd8"):
+            return _get_jpeg_size(data)
+        if data.startswith((b"GIF87a", b"GIF89a")):
+            return struct.unpack("<HH", data[6:10])
+        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            return _get_webp_size(data)
+    except struct.error:
+        pass
+    return None
+
+
+def _get_jpeg_size(data: bytes) -> tuple[int, int] | None:
+    # walk the segments up to the first SOF marker
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+        elif marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        else:
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+def _get_webp_size(data: bytes) -> tuple[int, int] | None:
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        bits = struct.unpack("<I", data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        return (int.from_bytes(data[24:27], "little") + 1,
+                int.from_bytes(data[27:30], "little") + 1)
+    return None
+
+
+def _zip_dir(arc_name: str, directory: Path, is_append: bool = False) -> None:
+    """
+    With 'is_append' the chapters are added to the existing archive.
+    A chapter that is in the archive already was re-uploaded,
+    its old pages are dropped from the archive first.
+    """
+    file_list = []
+    for filename in natsorted(directory.glob("**/*")):
+        if _is_service_file(filename):
+            continue
+        arcname = filename.relative_to(directory).as_posix()
+        if filename.is_dir():
+            arcname += "/"
+        file_list.append((filename, arcname))
+
+    is_append = is_append and Path(arc_name).is_file()
+    if is_append:
+        chapters = tuple({arcname.rpartition("/")[0] + "/"
+                          for _, arcname in file_list
+                          if "/" in arcname.rstrip("/")
+                          and not arcname.endswith("/")})
+        with zipfile.ZipFile(arc_name) as zip_file:
+            stale = {name for name in zip_file.namelist()
+                     if name.startswith(chapters) and name not in chapters}
+        if stale:
+            _drop_zip_entries(arc_name, stale)
+
+    with zipfile.ZipFile(arc_name, mode="a" if is_append else "w",
                          compression=zipfile.ZIP_STORED,
                          allowZip64=True) as zip_file:
-        for filename in natsorted(directory.glob("**/*")):
-            zip_file.write(filename, filename.relative_to(directory))
+        names = set(zip_file.namelist())
+        for filename, arcname in file_list:
+            if arcname in names:
+                continue
+            zip_file.write(filename, arcname)
+
+
+def _drop_zip_entries(arc_name: str, names: set[str]) -> None:
+    """Copy the archive without the entries and replace it."""
+    part_name = f"{arc_name}.part"
+    with zipfile.ZipFile(arc_name) as src, \
+         zipfile.ZipFile(part_name, mode="w",
+                         compression=zipfile.ZIP_STORED,
+                         allowZip64=True) as dst:
+        for info in src.infolist():
+            if info.filename in names:
+                continue
+            if info.is_dir():
+                dst.writestr(info, b"")
+                continue
+            with src.open(info) as src_file, dst.open(info, "w") as dst_file:
+                shutil.copyfileobj(src_file, dst_file)
+    os.replace(part_name, arc_name)
+
+
+def _get_archive_name(directory: Path, ext: str) -> Path:
+    return directory.with_suffix(directory.suffix + f".{ext}")
+
+
+def _get_free_name(arc_name: Path) -> Path:
+    # name archives like "Volume 1 (2).pdf"
+    for i in range(1, 100):
+        temp_path = arc_name.with_name(f"{arc_name.stem} ({i}){arc_name.suffix}")
+        if not temp_path.is_file():
+            return temp_path
+    return arc_name
+
+
+def _is_service_file(filename: Path) -> bool:
+    """Chapter id files and unfinished '.part' pages are not archived."""
+    return filename.name.startswith(".") or filename.suffix == ".part"
+
+
+def _get_affected_directories(manga_dir: Path, archive_mode: str,
+                              chapter_dirs: list[Path]) -> list[Path]:
+    if not chapter_dirs:
+        return []
+    if archive_mode == "manga":
+        return [manga_dir]
+    if archive_mode == "volume":
+        return natsorted({d.parent for d in chapter_dirs})
+    return natsorted(chapter_dirs)
 
 
 def _find_directories(manga_dir: Path, archive_mode: str,
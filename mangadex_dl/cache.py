@@ -0,0 +1,161 @@
+"""
+Mangadex-dl: cache.py
+Persistent cache of API responses (manga, authors, groups, feed pages).
+Entries expire by endpoint, expired entries with an ETag or Last-Modified
+are revalidated with a conditional request, the least recently used
+entries are evicted when the cache grows over its size.
+"""
+
+import os
+import time
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit, urlencode
+
+ENABLED = False
+MAX_SIZE = 32 * 1024 * 1024  # bytes of stored responses
+
+# seconds a response is used without asking the API again
+TTL = {
+    "author": 7 * 24 * 3600,
+    "group":  24 * 3600,
+    "manga":  3600,
+    "feed":   600,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key           TEXT PRIMARY KEY,
+    body          TEXT,
+    etag          TEXT,
+    last_modified TEXT,
+    expires       REAL,
+    accessed      REAL,
+    size          INTEGER
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the shared cache or None if it is disabled."""
+    global _cache
+    if not ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(_get_cache_path(), MAX_SIZE)
+        return _cache
+
+
+def get_endpoint(url: str) -> str | None:
+    """Return the TTL name of a cacheable API url or None."""
+    parts = urlsplit(url).path.strip("/").split("/")
+    if parts[-1] == "feed":
+        return "feed"
+    if parts[0] in TTL:
+        return parts[0]
+    return None
+
+
+def get_key(url: str, params: dict) -> str:
+    if not params:
+        return url
+    query = urlencode(sorted(params.items()), doseq=True)
+    return url + ("&" if "?" in url else "?") + query
+
+
+class ResponseCache:
+    """Safe to share between threads, every method holds the lock."""
+
+    def __init__(self, path: Path, max_size: int):
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(_SCHEMA)
+
+    def get(self, key: str):
+        """
+        Return (data, is_fresh, validators) of the stored response
+        or None. Validators are headers for a conditional request.
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT body, etag, last_modified, expires FROM responses "
+                "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+
+            body, etag, last_modified, expires = row
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?",
+                            (time.time(), key))
+
+        validators = {}
+        if etag:
+            validators["If-None-Match"] = etag
+        if last_modified:
+            validators["If-Modified-Since"] = last_modified
+
+        is_fresh = expires > time.time()
+        with self.lock:
+            self.stats["hits" if is_fresh else "misses"] += 1
+        return json.loads(body), is_fresh, validators
+
+    def put(self, key: str, data: dict, headers, ttl: float) -> None:
+        body = json.dumps(data, separators=(",", ":"))
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, body, headers.get("etag"),
+                 headers.get("last-modified"), now + ttl, now, len(body)))
+            self._evict()
+
+    def refresh(self, key: str, ttl: float) -> None:
+        """The API answered 304, the stored response is fresh again."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE responses SET expires = ? WHERE key = ?",
+                            (time.time() + ttl, key))
+            self.stats["revalidated"] += 1
+
+    def _evict(self) -> None:
+        size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        # evict down to 90% so that every put does not evict again
+        keys = []
+        for key, entry_size in self.db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"):
+            if size <= self.max_size * 0.9:
+                break
+            keys.append((key,))
+            size -= entry_size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def log_stats(self) -> None:
+        with self.lock:
+            logging.info("API cache: {hits} hits, {misses} misses, "
+                         "{revalidated} revalidated".format(**self.stats))
+
+
+def log_stats() -> None:
+    if _cache:
+        _cache.log_stats()
+
+
+def _get_cache_path() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "mangadex-dl" / "api-cache.db"
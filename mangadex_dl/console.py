@@ -4,15 +4,28 @@ Initializes the console version.
 """
 
 import traceback
+import concurrent.futures
 
 from mangadex_dl import utils
+from mangadex_dl import cache
+from mangadex_dl import library
 from mangadex_dl import parse
 from mangadex_dl import archive as ar
 from mangadex_dl import download as dl
 from mangadex_dl import duplicate as dup
 
+WATCHLIST_WORKERS = 3  # batches of 100 titles checked at the same time
+
 
 def init_console(args):
+    if args.verify:
+        _verify_console(args)
+        return
+
+    if args.watchlist:
+        _sync_watchlist(args)
+        return
+
     # input urls if they are not given by command line option
     if not args.manga_urls:
         while True:
@@ -28,10 +41,15 @@ def init_console(args):
     # download manga from list
     for manga_url in args.manga_urls:
         try:
-            _dl_console(manga_url, args)
+            if args.sync:
+                _sync_console(manga_url, args)
+            else:
+                _dl_console(manga_url, args)
         except Exception:
             print("{}\nSkip download.".format(traceback.format_exc()))
 
+    cache.log_stats()
+
 
 def _dl_console(manga_url, args):
     print("\nReceiving manga's info...")
@@ -42,12 +60,16 @@ def _dl_console(manga_url, args):
         len(args.manga_urls), manga_info.title))
 
     # get available chapters
-    chapters_list = utils.get_chapters_list(manga_info.uuid, args.language)
+    chapters_list = utils.get_chapters_list(manga_info.uuid, args.language,
+                                            callback=_print_feed_progress)
+    print()
 
     # duplicate check
     chapters_list = dup.resolve_duplicated_chapters(chapters_list,
                                                     args.resolve,
-                                                    _resolve_duplicates_manual_console)
+                                                    _resolve_duplicates_manual_console,
+                                                    args.priority,
+                                                    manga_info.uuid)
 
     # print chapters list
     _print_available_chapters(chapters_list)
@@ -73,18 +95,213 @@ def _dl_console(manga_url, args):
                                                    manga_info.title_en,
                                                    manga_info.uuid)
 
-    dl.download_chapters(requested_chapters, manga_directory, args.datasaver)
+    pipeline = None
+    stream = None
+    if args.archive and args.stream and args.ext != "pdf":
+        # pages are written straight into the archives
+        stream = ar.ZipStream(manga_directory, args.archive, args.ext)
+    elif args.archive and args.pipeline:
+        # archive chapters and volumes as soon as they are downloaded
+        pipeline = ar.ArchivePipeline(manga_directory, requested_chapters,
+                                      args.archive, args.keep, args.ext)
+
+    try:
+        dl.get_engine(args.engine).download_chapters(
+            requested_chapters, manga_directory, args.datasaver,
+            callback=pipeline and pipeline.add, stream=stream)
+    finally:
+        if stream:
+            stream.close()
+        if pipeline:
+            pipeline.close()
     print("\nChapters downloaded successfully")
 
     # archive
-    if args.archive:
+    if args.archive and not stream:
         print("\nArchiving downloaded chapters...")
-        ar.archive_manga(manga_directory, args.archive, args.keep, args.ext)
+        if pipeline:
+            pipeline.join()
+        else:
+            ar.archive_manga(manga_directory, args.archive, args.keep, args.ext)
         print("\nArchiving completed successfully")
 
     print(f"\nManga \"{manga_info.title}\" was successfully downloaded")
 
 
+def _sync_console(manga_url, args, manga_info=None):
+    """
+    Download chapters created or updated since the last sync of the manga
+    and archive only the affected volumes. Needs the library index.
+    The watchlist passes the manga info it has already received.
+    """
+    if manga_info is None:
+        print("\nReceiving manga's info...")
+        manga_info = _search_manga_info(manga_url, args.language)
+
+    print("\n[{:2}/{:2}] SYNC: {}".format(
+        args.manga_urls.index(manga_url)+1,
+        len(args.manga_urls), manga_info.title))
+
+    with library.open_index(utils.check_output_directory(args.outdir),
+                            force=True) as index:
+        sync_mark = index.get_sync_mark(manga_info.uuid, args.language)
+        incomplete = index.get_incomplete_chapters(manga_info.uuid)
+        chapters_list = utils.get_chapters_list(
+            manga_info.uuid, args.language,
+            _get_updated_since(sync_mark, incomplete))
+
+        requested_chapters = _get_sync_chapters(index, manga_info.uuid,
+                                                chapters_list, incomplete,
+                                                args)
+        print(f"New or updated chapters: {len(requested_chapters)}")
+
+        if requested_chapters:
+            manga_directory = utils.create_manga_directory(args.outdir,
+                                                           manga_info.title_en,
+                                                           manga_info.uuid)
+            # re-uploaded chapters are downloaded into their old directories
+            chapter_dirs = dl.get_engine(args.engine).download_chapters(
+                requested_chapters, manga_directory, args.datasaver,
+                resume=True, index=index)
+            print("\nChapters downloaded successfully")
+
+            if args.archive:
+                print("\nArchiving updated chapters...")
+                ar.archive_manga(manga_directory, args.archive, args.keep,
+                                 args.ext, chapter_dirs=chapter_dirs,
+                                 index=index)
+                print("\nArchiving completed successfully")
+
+        latest_update = utils.get_latest_update(chapters_list) or sync_mark
+        if latest_update:
+            index.set_sync_mark(manga_info.uuid, args.language,
+                                latest_update, manga_info.latest_chapter)
+
+    print(f"\nManga \"{manga_info.title}\" is up to date")
+
+
+def _sync_watchlist(args):
+    """
+    Sync every title of the watchlist file. Batches of 100 titles are
+    checked concurrently for new or re-uploaded chapters since their
+    last sync, then the updated titles are synced one by one.
+    """
+    args.manga_urls = []
+    with open(args.watchlist, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            manga_uuid = utils.get_uuid(line)
+            if manga_uuid:
+                args.manga_urls.append(manga_uuid)
+            else:
+                print(f"'{line}' is not a manga URL or UUID. Skipped.")
+
+    print(f"\nChecking {len(args.manga_urls)} titles for updates...")
+
+    with library.open_index(utils.check_output_directory(args.outdir),
+                            force=True) as index, \
+         concurrent.futures.ThreadPoolExecutor(
+            max_workers=WATCHLIST_WORKERS) as executor:
+        future_list = [executor.submit(_check_watchlist,
+                                       args.manga_urls[i:i+100],
+                                       index, args.language)
+                       for i in range(0, len(args.manga_urls), 100)]
+        manga_list = [manga for future in future_list
+                      for manga in future.result()]
+
+    args.manga_urls = [manga.uuid for manga in manga_list]
+    print(f"Titles with updates: {len(args.manga_urls)}")
+
+    for manga in manga_list:
+        try:
+            _sync_console(manga.uuid, args, manga)
+        except Exception:
+            print("{}\nSkip download.".format(traceback.format_exc()))
+
+
+def _check_watchlist(manga_uuids, index, language):
+    """Return manga info of the titles updated since their last sync."""
+    manga_list = utils.get_manga_list(manga_uuids, language)
+
+    updated = set()
+    sync_marks = {}
+    for manga in manga_list:
+        sync_mark = index.get_sync_mark(manga.uuid, language)
+        if not sync_mark or \
+           index.get_latest_chapter(manga.uuid, language) != \
+           manga.latest_chapter or \
+           index.get_incomplete_chapters(manga.uuid):
+            updated.add(manga.uuid)
+        else:
+            sync_marks[manga.uuid] = sync_mark
+
+    # re-uploads don't change the latest uploaded chapter
+    updated |= utils.get_updated_manga(sync_marks, language)
+    return [manga for manga in manga_list if manga.uuid in updated]
+
+
+def _verify_console(args):
+    """
+    Check the pages of every chapter in the library index. The pages
+    of broken chapters are forgotten, so the next sync fetches them.
+    """
+    print("\nVerifying the library...")
+    with library.open_index(utils.check_output_directory(args.outdir),
+                            force=True) as index:
+        broken = index.verify()
+        for directory in broken.values():
+            print(f"  Missing or damaged pages: {directory}")
+        index.drop_pages(list(broken))
+
+    print(f"Broken chapters: {len(broken)}")
+    if broken:
+        print("Sync their manga to download them again")
+
+
+def _get_updated_since(sync_mark, incomplete):
+    """
+    The feed since the last sync, or since the oldest chapter
+    with missing pages, so that it is fetched again.
+    """
+    if not sync_mark or not incomplete:
+        return sync_mark
+    if None in incomplete.values():
+        return None
+    return min(sync_mark, *incomplete.values())
+
+
+def _get_sync_chapters(index, manga_uuid, chapters_list, incomplete, args):
+    """
+    Return chapters that are not in the index, were re-uploaded
+    or have missing pages. Unless all duplicates are wanted, a new
+    chapter is skipped if another group's version of it was downloaded.
+    """
+    resolve = args.resolve
+    downloaded = index.get_chapters(manga_uuid)
+    numbers = index.get_chapter_numbers(manga_uuid)
+    requested_chapters = []
+
+    for chapter in chapters_list:
+        if chapter.id in downloaded:
+            if downloaded[chapter.id] != chapter.updated_at or \
+               chapter.id in incomplete:
+                requested_chapters.append(chapter)
+        elif resolve == "all" or \
+                (chapter.volume, chapter.chapter) not in numbers:
+            requested_chapters.append(chapter)
+
+    if resolve == "all":
+        return requested_chapters
+
+    # unattended mode, so the manual choice falls back to "one"
+    return dup.resolve_duplicated_chapters(requested_chapters,
+                                           "profile" if resolve == "profile"
+                                           else "one",
+                                           None, args.priority, manga_uuid)
+
+
 def _search_manga_info(manga_url, language):
 
     if utils.get_uuid(manga_url):
@@ -115,14 +332,18 @@ def _print_found_manga_list(manga_list):
             i, manga.title, manga.year, ", ".join(manga.authors)))
 
 
+def _print_feed_progress(received, total):
+    print(f"\rReceived chapters [{received:4}/{total:4}]...", end="")
+
+
 def _print_available_chapters(chapters_list):
 
     print(f"Available chapters: (total {len(chapters_list)})", end="")
 
     volume_number = None
     for chapter in chapters_list:
-        chapter_volume = chapter["attributes"]["volume"] or "Unknown"
-        chapter_name = chapter["attributes"]["chapter"] or "Oneshot"
+        chapter_volume = chapter.volume_name
+        chapter_name = chapter.chapter_name
 
         if volume_number != chapter_volume:
             volume_number = chapter_volume
@@ -138,8 +359,10 @@ def _resolve_duplicates_manual_console(chapters_list,
     for group in scanlation_groups:
         group_priority = input("Specify priority for "
                                f"{group['attributes']['name']}. "
-                               "[1-5], highest is 1.\n> ")
-        group["priority"] = group_priority
+                               "[1-5], highest is 1. "
+                               f"(leave blank for {group['priority']})\n> ")
+        if group_priority:
+            group["priority"] = group_priority
     print("Groups are prioritized\n")
 
     chapters_list = dup.resolve_scanlate_priority_function(chapters_list,
@@ -3,146 +3,650 @@ Mangadex-dl: download.py
 Handling low-level HTTP requests and loading images.
 """
 
+import os
+import re
 import time
+import hashlib
+import random
 import logging
+import threading
+import email.utils
 import requests
 import concurrent.futures
 from pathlib import Path
 from collections import deque
+from urllib.parse import urlsplit
 
+from mangadex_dl import cache
+from mangadex_dl import library
+from mangadex_dl import progress
 from mangadex_dl.instance import SESSION
 
+CHAPTER_PREFETCH = 3  # at-home servers requested ahead of the current chapter
+IMAGE_WORKERS = 5
+CHUNK_SIZE = 64 * 1024
+RESUME = False        # reuse chapter directories and skip downloaded pages
+CHAPTER_ID_FILE = ".chapter-id"
+FSYNC = False         # fsync every page before it is renamed into place
 
-def url_request(url, params={}, json=False):
-    error = None
-    for i in range(5):
+IMAGE_ATTEMPTS = 4    # image fetch rounds, the node may change between them
+
+FAILOVER_ERRORS = 3   # failed or slow fetches before the node is replaced
+FAILOVER_REFRESH = 2  # fresh nodes to try before the origin server
+SLOW_REQUEST = 20     # seconds, slower fetches count as failures
+FALLBACK_URL = "https://uploads.mangadex.org"
+
+API_URL = "https://api.mangadex.org"  # or a stand-in of the MangaDex API
+
+REPORT_NODES = False  # send fetch results to the MangaDex@Home network
+REPORT_URL = "https://api.mangadex.network/report"
+
+
+def url_request(url, params={}, json=False, retry=None):
+    return _request(url, params, None, retry,
+                    _read_json if json else _read_content)
+
+
+def _request(url, params, headers, retry, read):
+    """
+    GET the url with retries and return read(response).
+    Errors raised by read() are retried as well.
+    """
+    retry = retry or RETRY_POLICY
+    deadline = time.monotonic() + retry.deadline
+
+    for attempt in range(retry.attempts):
         try:
-            _DownloadLimits.check()
+            limiter = _get_limiter(url)
+            time.sleep(limiter.reserve())
 
-            r = SESSION.get(url, timeout=(10, 120), params=params)
+            r = SESSION.get(url, timeout=(10, 120), params=params,
+                            headers=headers)
+            limiter.update(r.headers)
 
             r.raise_for_status()
 
-            if json:
-                response = r.json()
-            else:
-                response = r.content
+            return read(r)
+        except Exception as err:
+            delay = retry.next_delay(attempt, *_get_error_status(err),
+                                     deadline)
+            if delay is None:
+                logging.error(f"URL Request: {err}")
+                raise
+            time.sleep(delay)
+
+
+def _read_json(r):
+    return r.json()
+
 
-            if not json:
-                content_length = r.headers.get("content-length")
-                received_bytes = len(response)
+def _read_content(r):
+    response = r.content
 
-                if content_length and received_bytes != int(content_length):
-                    raise requests.RequestException(
-                        "IncompleteRead: "
-                        f"{received_bytes} from {content_length}")
+    content_length = r.headers.get("content-length")
+    received_bytes = len(response)
 
-            return response
+    if content_length and received_bytes != int(content_length):
+        raise requests.RequestException(
+            "IncompleteRead: "
+            f"{received_bytes} from {content_length}")
+
+    return response
+
+
+def _read_cacheable(r):
+    if r.status_code == 304:
+        return r.status_code, r.headers, None
+    return r.status_code, r.headers, r.json()
+
+
+def url_download(url, file_path, retry=None):
+    """
+    Stream the response into '<file_path>.part' and rename it into place,
+    so a crash never leaves a truncated page behind. An existing part
+    is continued with a Range request.
+    Returns the number of bytes, whether the node had it cached
+    and the sha256 of the page.
+    """
+    retry = retry or RETRY_POLICY
+    deadline = time.monotonic() + retry.deadline
+
+    attempt = 0
+    while True:
+        try:
+            limiter = _get_limiter(url)
+            time.sleep(limiter.reserve())
+
+            with SESSION.get(url, timeout=(10, 120), stream=True,
+                             headers=_get_range_headers(file_path)) as r:
+                limiter.update(r.headers)
+                r.raise_for_status()
+
+                part_file = _PartFile(file_path,
+                                      r.status_code,
+                                      r.headers.get("content-length"),
+                                      r.headers.get("content-range"))
+                try:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        part_file.write(chunk)
+                    part_file.commit()
+                finally:
+                    part_file.close()
+
+            return part_file.size, _is_cached(r.headers), \
+                part_file.sha256.hexdigest()
         except Exception as err:
-            error = err
-            time.sleep(1 if i < 3 else 10)
-    logging.error(f"URL Request: {error}")
-    raise error
+            status, headers = _get_error_status(err)
+            if _drop_stale_part(file_path, status):
+                continue
+
+            delay = retry.next_delay(attempt, status, headers, deadline)
+            if delay is None:
+                logging.error(f"URL Request: {err}")
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def _get_range_headers(file_path):
+    part_path = _get_part_path(file_path)
+    if part_path.is_file() and part_path.stat().st_size:
+        return {"Range": f"bytes={part_path.stat().st_size}-"}
+    return None
+
+
+def _drop_stale_part(file_path, status):
+    """
+    On 416 the part doesn't match the file on the server. Delete it
+    and return True, the page is requested again from the first byte
+    right away, without a Range header it can't get 416 again.
+    """
+    part_path = _get_part_path(file_path)
+    if status != 416 or not part_path.is_file():
+        return False
+    part_path.unlink()
+    return True
+
+
+class _PartFile:
+    """
+    Page being written to '<file_path>.part'. The size is checked
+    against Content-Length while streaming, and commit() renames
+    the complete file into place. A 206 response is appended to the
+    existing part if its Content-Range starts where the part ends,
+    an unfinished part is kept to be continued later.
+    """
+
+    def __init__(self, file_path, status, content_length, content_range=None):
+        self.file_path = file_path
+        self.part_path = _get_part_path(file_path)
+
+        self.sha256 = hashlib.sha256()
+
+        if status == 206:
+            self._check_range(content_range)
+
+        if status == 206 and self.part_path.is_file():
+            self.file = open(self.part_path, mode="ab+")
+            self.file.seek(0)
+            hashlib.file_digest(self.file, lambda: self.sha256)
+            self.size = self.file.tell()
+        else:
+            self.size = 0
+            self.file = open(self.part_path, mode="wb")
+
+        self.expected = None
+        if content_length:
+            self.expected = self.size + int(content_length)
+
+    def _check_range(self, content_range):
+        # "bytes 1000-1999/2000"
+        start = None
+        if content_range and content_range.startswith("bytes "):
+            start = content_range[6:].partition("-")[0]
+        part_size = self.part_path.stat().st_size \
+            if self.part_path.is_file() else 0
+
+        if start is None or not start.isdigit() or int(start) != part_size:
+            # the next attempt starts from the first byte
+            self.part_path.unlink(missing_ok=True)
+            raise requests.RequestException(
+                f"Content-Range '{content_range}' doesn't continue "
+                f"{part_size} bytes of the part")
+
+    def write(self, chunk):
+        if self.expected is not None and \
+           self.size + len(chunk) > self.expected:
+            raise requests.RequestException(
+                f"IncompleteRead: more than {self.expected} bytes")
+        self.size += len(chunk)
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        if self.expected is not None and self.size != self.expected:
+            raise requests.RequestException(
+                f"IncompleteRead: {self.size} from {self.expected}")
+
+        if FSYNC:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+        self.file.close()
+        os.replace(self.part_path, self.file_path)
+
+    def close(self):
+        self.file.close()
+
+
+def _get_part_path(file_path):
+    return file_path.with_name(file_path.name + ".part")
+
+
+def _is_cached(headers):
+    return headers.get("X-Cache", "").startswith("HIT")
 
 
 def get_json(url, params={}):
-    return url_request(url, params=params, json=True)
+    """Manga, author, group and feed responses are cached if enabled."""
+    response_cache = cache.get_cache()
+    endpoint = cache.get_endpoint(url)
+    if not (response_cache and endpoint):
+        return url_request(url, params=params, json=True)
+
+    key = cache.get_key(url, params)
+    ttl = cache.TTL[endpoint]
+    cached = response_cache.get(key)
+    if cached and cached[1]:
+        return cached[0]
+
+    status, headers, data = _request(url, params,
+                                     cached[2] if cached else None,
+                                     None, _read_cacheable)
+    if status == 304:
+        response_cache.refresh(key, ttl)
+        return cached[0]
+
+    response_cache.put(key, data, headers, ttl)
+    return data
+
+
+def get_engine(name):
+    """
+    Return the module providing download_chapters() for the engine name:
+    "thread" (default) or "async" (requires aiohttp).
+    """
+    if name == "async":
+        from mangadex_dl import download_async
+        return download_async
+
+    from mangadex_dl import download
+    return download
 
 
 def download_chapters(requested_chapters,
                       out_directory,
                       is_datasaver,
-                      gui={}):
-
-    chapter_count = 1
+                      gui={},
+                      callback=None,
+                      stream=None,
+                      resume=None,
+                      index=None):
+    """
+    Download chapters through one long-lived pool of image fetches.
+    At-home servers for the next chapters are requested in advance,
+    and pages of the next chapter are queued while the current one
+    is finishing, so the pool doesn't drain at chapter boundaries.
+    callback(chapter, directory) is called for every finished chapter,
+    the directory is None if the chapter has no pages.
+    With 'stream' (archive.ZipStream) the pages are written into
+    archives, and chapter directories are not created.
+    'resume' overrides the resume setting, and chapters are recorded in
+    the open library 'index' instead of the index of the settings.
+    Returns the list of chapter directories.
+    """
     chapter_count_max = len(requested_chapters)
-
-    for chapter in requested_chapters:
-        chapter_number = chapter["attributes"]["chapter"] or "Oneshot"
-        chapter_volume = chapter["attributes"]["volume"] or "Unknown"
-        chapter_name = chapter["attributes"]["title"] or ""
+    chapter_directories = _find_resume_directories(out_directory, resume)
+    scheduled = deque()
+    directories = []
+    node_stats = _NodeStats()
+    is_own_index = index is None
+    if is_own_index:
+        index = library.open_index(out_directory.parent)
+
+    with progress.reporting(gui) as bus, \
+         concurrent.futures.ThreadPoolExecutor(
+            max_workers=CHAPTER_PREFETCH) as server_pool, \
+         concurrent.futures.ThreadPoolExecutor(
+            max_workers=IMAGE_WORKERS) as image_pool:
+
+        bus.put("reset")
+
+        # pages are cancelled, not dropped by shutting down the pool:
+        # a worker still takes every cancelled page from the queue and
+        # wakes up as_completed() of its chapter.
+        # Chapters are scheduled under the lock, so none comes after it.
+        cancelled = threading.Event()
+        cancel_lock = threading.Lock()
+        page_futures = []
+
+        def cancel():
+            with cancel_lock:
+                cancelled.set()
+                for future in page_futures:
+                    future.cancel()
 
         if gui.get("set"):
-            # This 'gui' object stores data to
-            # update progressbars and text in GUI
-            gui["progress_chapter"].set((chapter_count/chapter_count_max)*100)
-            gui["progress_chapter_text"].set(
-                f"[ {chapter_count} / {chapter_count_max} ]")
+            gui["cancel"] = cancel
+
+        servers = deque(server_pool.submit(_get_chapter_server, chapter.id)
+                        for chapter in requested_chapters[:CHAPTER_PREFETCH])
+
+        try:
+            for chapter_count, chapter in enumerate(requested_chapters,
+                                                    start=1):
+                prefetch_index = chapter_count - 1 + CHAPTER_PREFETCH
+                if prefetch_index < chapter_count_max:
+                    servers.append(server_pool.submit(
+                        _get_chapter_server,
+                        requested_chapters[prefetch_index].id))
+
+                chapter_json = servers.popleft().result()
+                with cancel_lock:
+                    if cancelled.is_set():
+                        logging.warning("Download cancelled")
+                        break
+                    scheduled_chapter = _schedule_chapter(image_pool,
+                                                          chapter,
+                                                          chapter_json,
+                                                          out_directory,
+                                                          is_datasaver,
+                                                          chapter_directories,
+                                                          stream,
+                                                          node_stats)
+                    if scheduled_chapter:
+                        page_futures += scheduled_chapter[2]
+                scheduled.append((chapter, chapter_count, scheduled_chapter))
+                if scheduled_chapter:
+                    directories.append(scheduled_chapter[1])
+
+                # wait for the previous chapter only when
+                # the pages of this one are already queued
+                if len(scheduled) > 1:
+                    _wait_chapter(*scheduled.popleft(),
+                                  chapter_count_max, bus, index, callback)
+
+            # pages of a cancelled download are cancelled futures
+            while scheduled:
+                _wait_chapter(*scheduled.popleft(),
+                              chapter_count_max, bus, index, callback)
+        finally:
+            if gui.get("set"):
+                gui["cancel"] = None
+
+    if index and is_own_index:
+        index.close()
+
+    node_stats.log()
+    return directories
+
+
+def _get_chapter_server(chapter_id):
+    return get_json(f"{API_URL}/at-home/server/{chapter_id}")
+
+
+def _schedule_chapter(image_pool, chapter, chapter_json, out_directory,
+                      is_datasaver, chapter_directories, stream, node_stats):
+    """
+    Submit all pages of the chapter to the image pool.
+    Returns the node, the directory and a list of futures with page
+    records, or None if the chapter has no pages.
+    """
+    prepared = _prepare_chapter(chapter, chapter_json, out_directory,
+                                is_datasaver, chapter_directories, stream,
+                                node_stats)
+    if prepared is None:
+        return None
+
+    server, directory_chapter, pages, writer = prepared
+    future_list = []
+
+    for image_count, image_name, is_done in pages:
+        if is_done:
+            future = concurrent.futures.Future()
+            future.set_result(_get_page_record(directory_chapter,
+                                               image_count, image_name,
+                                               writer))
         else:
-            # Otherwise, print the console output
-            print("\nDownloading chapter [{:3}/{:3}] "
-                  "Ch.{} {}".format(chapter_count,
-                                    chapter_count_max,
-                                    chapter_number,
-                                    chapter_name))
+            future = image_pool.submit(_download_image,
+                                       server,
+                                       image_name,
+                                       image_count,
+                                       directory_chapter,
+                                       writer)
+        future_list.append(future)
+
+    return server, directory_chapter, future_list
+
+
+def _prepare_chapter(chapter, chapter_json, out_directory,
+                     is_datasaver, chapter_directories, stream, node_stats):
+    """
+    Return the node, the directory, the pages of the chapter
+    as (image_count, image_name, is_done) and the page writer of
+    the stream, or None if it has no pages.
+    In resume mode, when 'chapter_directories' isn't None, the directory
+    of a previous download is reused and valid pages already on disk
+    are marked as done. Pages already
+    in the archive of the stream are done as well.
+    Fetches of the node are counted in 'node_stats'.
+    """
+    if is_datasaver:
+        image_url_list = chapter_json["chapter"]["dataSaver"]
+    else:
+        image_url_list = chapter_json["chapter"]["data"]
+
+    if len(image_url_list) == 0:
+        return None
+
+    server = _ChapterServer(chapter.id, chapter_json, is_datasaver,
+                            node_stats)
+
+    if stream:
+        writer = stream.add_chapter(chapter, [
+            _get_page_name(image_count, image_name)
+            for image_count, image_name in enumerate(image_url_list, start=1)])
+        pages = [(image_count, image_name, writer.is_done(image_count))
+                 for image_count, image_name
+                 in enumerate(image_url_list, start=1)]
+        return server, writer.directory, pages, writer
+
+    is_resume = chapter_directories is not None
+    directory_chapter = chapter_directories.get(chapter.id) \
+        if is_resume else None
+    if directory_chapter is None:
+        directory_chapter = _create_chapter_directory(out_directory,
+                                                      chapter.volume_name,
+                                                      chapter.chapter_name)
+        (directory_chapter / CHAPTER_ID_FILE).write_text(chapter.id)
 
-        chapter_json = get_json("https://api.mangadex.org/at-home"
-                                f"/server/{chapter['id']}")
+    pages = []
+    for image_count, image_name in enumerate(image_url_list, start=1):
+        image_file_path = _get_image_path(directory_chapter,
+                                          image_count, image_name)
+        is_done = is_resume and _is_page_valid(image_file_path, image_name)
+        pages.append((image_count, image_name, is_done))
 
-        # "https://uploads.mangadex.org/data/3ed5ed7ba35891cc9902f94e8488a51a/"
-        base_url = "{}/{}/{}/".format(chapter_json["baseUrl"],
-                                      "data-saver" if is_datasaver else "data",
-                                      chapter_json["chapter"]["hash"])
+    return server, directory_chapter, pages, None
 
-        if is_datasaver:
-            image_url_list = chapter_json["chapter"]["dataSaver"]
-        else:
-            image_url_list = chapter_json["chapter"]["data"]
 
-        image_count = 1
-        image_count_downloaded = 0
-        image_count_max = len(image_url_list)
+def _find_resume_directories(out_directory, resume):
+    """Chapter directories to resume or None, 'resume' None is the setting."""
+    if resume is None:
+        resume = RESUME
+    return _find_chapter_directories(out_directory) if resume else None
 
-        if image_count_max == 0:
-            print(f"  Chapter {chapter_number} is not available on Mangadex.")
-            continue
 
-        directory_chapter = _create_chapter_directory(out_directory,
-                                                      chapter_volume,
-                                                      chapter_number)
+def _find_chapter_directories(out_directory):
+    """Return {chapter uuid: directory} of chapters downloaded before."""
+    chapter_directories = {}
+    for id_file in out_directory.glob(f"*/*/{CHAPTER_ID_FILE}"):
+        chapter_directories[id_file.read_text().strip()] = id_file.parent
+    return chapter_directories
 
-        thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=5)
-        if gui.get("set"):
-            gui["thread_pool"] = thread_pool
-        with thread_pool as executor:
-            future_list = []
-
-            for image_url in image_url_list:
-                future_list.append(executor.submit(_download_image,
-                                                   base_url + image_url,
-                                                   image_count,
-                                                   directory_chapter))
-                image_count += 1
-
-            for future in concurrent.futures.as_completed(future_list):
-                image_count_downloaded += 1
-                if gui.get("set"):
-                    gui["progress_page"].set(
-                        (image_count_downloaded/image_count_max)*100)
-                    gui["progress_page_text"].set(
-                        f"[ {image_count_downloaded} / {image_count_max} ]")
-                else:
-                    print(f"\r  Downloaded images [{image_count_downloaded:3}/"
-                          f"{image_count_max:3}]...", end="")
 
-        if gui.get("set"):
-            gui["progress_page"].set(0)
-            gui["progress_page_text"].set("[ - / - ]")
+def _get_image_path(directory_chapter, image_count, image_name):
+    return directory_chapter / _get_page_name(image_count, image_name)
+
+
+def _get_page_name(image_count, image_name):
+    return "{:03d}{}".format(image_count, Path(image_name).suffix)
+
+
+def _is_page_valid(image_file_path, image_name):
+    """Check a page on disk against the sha256 in its at-home file name."""
+    if not image_file_path.is_file() or image_file_path.stat().st_size == 0:
+        return False
+
+    # "x1-b765e86d5ecbc932cf3f517a8604f6ac6d8a7f379b0277a117dc7c09c53d041e.png"
+    match = re.search(r"-([0-9a-f]{64})\.", image_name)
+    if not match:
+        return True
+
+    with open(image_file_path, mode="rb") as image_file:
+        return hashlib.file_digest(image_file, "sha256").hexdigest() == \
+            match.group(1)
+
+
+def _wait_chapter(chapter, chapter_count, scheduled_chapter,
+                  chapter_count_max, bus, index, callback):
+    _report_chapter(chapter, chapter_count, chapter_count_max, bus)
+
+    if not scheduled_chapter:
+        _report_unavailable(chapter, bus)
+        if callback:
+            callback(chapter, None)
+        return
 
-        chapter_count += 1
+    server, directory_chapter, future_list = scheduled_chapter
+    image_count_downloaded = 0
+    image_count_max = len(future_list)
 
+    for future in concurrent.futures.as_completed(future_list):
+        image_count_downloaded += 1
+        _report_page(image_count_downloaded, image_count_max,
+                     None if future.cancelled() else future.result(), bus)
 
-def _download_image(full_url, image_count, directory_chapter):
+    _report_chapter_done(bus)
 
-    image_file_path = directory_chapter / "{:03d}{}".format(
-        image_count, Path(full_url).suffix)
+    if index:
+        _add_chapter_to_index(index, chapter, server, directory_chapter,
+                              [None if f.cancelled() else f.result()
+                               for f in future_list])
 
+    # a cancelled chapter is left to be resumed
+    if callback and not any(f.cancelled() for f in future_list):
+        callback(chapter, directory_chapter)
+
+
+def _add_chapter_to_index(index, chapter, server, directory_chapter, pages):
+    # failed and cancelled pages are None, sync fetches them again
+    # since the chapter has fewer page rows than pages
     try:
-        data = url_request(full_url)
-        with open(image_file_path, mode="wb") as image_file:
-            image_file.write(data)
+        index.add_chapter(chapter, directory_chapter, server.hash, len(pages),
+                          [page for page in pages if page])
     except Exception as err:
-        logging.error(f"File download failed ({image_file_path}): {err}")
+        logging.error(f"Library index update failed: {err}")
+
+
+def _report_chapter(chapter, chapter_count, chapter_count_max, bus):
+    bus.put("chapter", chapter=chapter,
+            count=chapter_count, total=chapter_count_max)
+
+
+def _report_unavailable(chapter, bus):
+    bus.put("unavailable", chapter=chapter)
+
+
+def _report_page(image_count_downloaded, image_count_max, page, bus):
+    # pages found on disk in resume mode have no node and don't count
+    # into the download speed
+    bus.put("page", count=image_count_downloaded, total=image_count_max,
+            size=page[3] if page and page[2] else 0)
+
+
+def _report_chapter_done(bus):
+    bus.put("chapter_done")
+
+
+def _download_image(server, image_name, image_count, directory_chapter,
+                    writer=None):
+    """
+    Download a page, failing over to other nodes.
+    With a writer the page is kept in memory and put into the archive.
+    Returns the page record for the library index or None.
+    """
+    image_file_path = _get_image_path(directory_chapter,
+                                      image_count, image_name)
+
+    error = None
+    for i in range(IMAGE_ATTEMPTS):
+        full_url = server.get_url(image_name)
+        start = time.monotonic()
+        try:
+            if writer:
+                size, cached, checksum = _download_page(full_url, writer,
+                                                        image_count)
+            else:
+                size, cached, checksum = url_download(
+                    full_url, image_file_path, retry=IMAGE_RETRY_POLICY)
+        except Exception as err:
+            error = err
+            if server.report(full_url, False, 0, time.monotonic() - start):
+                server.switch(_get_chapter_server_safe(server.chapter_id))
+            while server.switching:
+                # another page is already requesting a new node
+                time.sleep(0.2)
+            continue
+
+        node = server.get_node(full_url)
+        if server.report(full_url, True, size,
+                         time.monotonic() - start, cached):
+            server.switch(_get_chapter_server_safe(server.chapter_id))
+        return image_count, image_name, node, size, checksum
+
+    logging.error(f"File download failed ({image_file_path}): {error}")
+    if writer:
+        writer.put(image_count, None)
+    return None
+
+
+def _download_page(url, writer, image_count):
+    """Same as url_download, but into the archive."""
+    data, cached = _request(url, None, None, IMAGE_RETRY_POLICY, _read_page)
+    writer.put(image_count, data)
+    return len(data), cached, hashlib.sha256(data).hexdigest()
+
+
+def _read_page(r):
+    return _read_content(r), _is_cached(r.headers)
+
+
+def _get_page_record(directory_chapter, image_count, image_name, writer=None):
+    """Record of a page downloaded before, checked by _is_page_valid."""
+    if writer:
+        size = writer.get_size(image_count)
+    else:
+        size = _get_image_path(directory_chapter,
+                               image_count, image_name).stat().st_size
+    return image_count, image_name, None, size, None
+
+
+def _get_chapter_server_safe(chapter_id):
+    try:
+        return _get_chapter_server(chapter_id)
+    except Exception:
+        return None
 
 
 def _create_chapter_directory(out_directory, chapter_volume, chapter_number):
@@ -160,13 +664,274 @@ def _create_chapter_directory(out_directory, chapter_volume, chapter_number):
     return directory_chapter
 
 
-class _DownloadLimits:
-    last_requests = deque(maxlen=5)
+class _ChapterServer:
+    """
+    MangaDex@Home node serving the pages of one chapter.
+    Image fetches report to it, and once a node has failed or was too
+    slow FAILOVER_ERRORS times, report() returns True exactly once:
+    the caller then requests a fresh node and passes it to switch().
+    After FAILOVER_REFRESH fresh nodes the origin server is used.
+    """
+
+    def __init__(self, chapter_id, chapter_json, is_datasaver, node_stats):
+        self.chapter_id = chapter_id
+        self.node_stats = node_stats
+        self.quality = "data-saver" if is_datasaver else "data"
+        self.hash = chapter_json["chapter"]["hash"]
+        self.base_url = chapter_json["baseUrl"]
+        self.errors = 0
+        self.refreshed = 0
+        self.switching = False
+        self.lock = threading.Lock()
+
+    def get_url(self, image_name):
+        # "https://uploads.mangadex.org/data/3ed5ed7ba35891cc9902f94e8488a51a/"
+        return f"{self.base_url}/{self.quality}/{self.hash}/{image_name}"
+
+    def get_node(self, url):
+        return url.split(f"/{self.quality}/", 1)[0]
+
+    def report(self, url, success, size, duration, cached=False):
+        """Record the result of a fetch, return True if a new node is due."""
+        base_url = self.get_node(url)
+        self.node_stats.add(base_url, success, size, duration)
+
+        if REPORT_NODES and base_url != FALLBACK_URL:
+            _report_pool.submit(_send_node_report,
+                                url, success, cached, size, duration)
+
+        if success and duration < SLOW_REQUEST:
+            return False
+
+        with self.lock:
+            if base_url != self.base_url or self.switching:
+                return False
+            self.errors += 1
+            if self.errors < FAILOVER_ERRORS:
+                return False
+            self.switching = True
+            return True
+
+    def switch(self, chapter_json):
+        """Move to the node from a fresh at-home response or the origin."""
+        with self.lock:
+            old_url = self.base_url
+            if chapter_json and self.refreshed < FAILOVER_REFRESH and \
+               chapter_json["baseUrl"] != old_url:
+                self.refreshed += 1
+                self.base_url = chapter_json["baseUrl"]
+            else:
+                self.base_url = FALLBACK_URL
+            self.errors = 0
+            self.switching = False
+
+        logging.warning(f"Image server {old_url} is failing, "
+                        f"switched to {self.base_url}")
+
+
+class _NodeStats:
+    """
+    Requests, errors, bytes and seconds spent per image server
+    in one download_chapters() call.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def add(self, node, success, size, duration):
+        with self.lock:
+            stats = self.nodes.setdefault(node, {"requests": 0, "errors": 0,
+                                                 "bytes": 0, "seconds": 0.0})
+            stats["requests"] += 1
+            stats["errors"] += 0 if success else 1
+            stats["bytes"] += size
+            stats["seconds"] += duration
+
+    def copy(self):
+        with self.lock:
+            return {node: dict(stats) for node, stats in self.nodes.items()}
+
+    def log(self):
+        for node, stats in self.copy().items():
+            logging.info("{}: {} requests, {} errors, {:.1f}s avg, "
+                         "{:.0f} KiB/s".format(
+                             node, stats["requests"], stats["errors"],
+                             stats["seconds"] / stats["requests"],
+                             stats["bytes"] / 1024 / (stats["seconds"] or 1)))
+
+
+_report_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def _send_node_report(url, success, cached, size, duration):
+    """Report the fetch result as the MangaDex@Home network expects."""
+    try:
+        SESSION.post(REPORT_URL, timeout=10, json={
+            "url": url,
+            "success": success,
+            "cached": cached,
+            "bytes": size,
+            "duration": int(duration * 1000)})
+    except Exception as err:
+        logging.debug(f"Node report failed: {err}")
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is tried again.
+    Errors are classified by HTTP status: other 4xx are fatal,
+    429 is rate-limited, network errors, 408 and 5xx are retryable.
+    Delays grow exponentially with jitter unless the server
+    sends Retry-After, and all attempts fit into 'deadline' seconds.
+    """
+
+    FATAL = "fatal"
+    RETRY = "retry"
+    RATE_LIMITED = "rate-limited"
+
+    def __init__(self, attempts=5, backoff=1, max_delay=30, deadline=300):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def classify(self, status):
+        if status is None or status == 408 or status >= 500:
+            return self.RETRY
+        if status == 429:
+            return self.RATE_LIMITED
+        return self.FATAL
+
+    def next_delay(self, attempt, status, headers, deadline):
+        """Return seconds to wait before the next attempt or None."""
+        if self.classify(status) == self.FATAL or \
+           attempt + 1 >= self.attempts:
+            return None
+
+        delay = _get_retry_after(headers)
+        if delay is None:
+            delay = min(self.max_delay, self.backoff * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+
+        if time.monotonic() + delay > deadline:
+            return None
+        return delay
+
+
+RETRY_POLICY = RetryPolicy()
+# a failing node is replaced instead of retried for long
+IMAGE_RETRY_POLICY = RetryPolicy(attempts=2, deadline=60)
+
+
+def _get_error_status(err):
+    """Return HTTP status and headers of a failed request if any."""
+    response = getattr(err, "response", None)
+    if response is not None:
+        return response.status_code, response.headers
+
+    # aiohttp.ClientResponseError
+    if isinstance(getattr(err, "status", None), int):
+        return err.status, err.headers or {}
+
+    return None, {}
+
+
+class _RateLimiter:
+    """
+    Token bucket shared by threads and asyncio tasks.
+    reserve() takes a token under a short lock and returns how long
+    the caller has to wait for it, so the caller decides how to sleep.
+    A rate of 0 disables the limit, but server hints still apply.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.blocked_until - now)
+
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+
+            return delay
+
+    def update(self, headers):
+        """Pause the bucket if the server asks to slow down."""
+        retry_after = _get_retry_after(headers)
+        if retry_after:
+            with self.lock:
+                self.blocked_until = max(self.blocked_until,
+                                         time.monotonic() + retry_after)
+
+
+def _get_retry_after(headers):
+    """Return seconds to wait according to the response headers or None."""
+    if headers.get("Retry-After"):
+        value = headers["Retry-After"]
+        try:
+            return max(0, float(value))
+        except ValueError:
+            try:
+                date = email.utils.parsedate_to_datetime(value)
+                return max(0, date.timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    # MangaDex sends the unix time when the limit resets
+    if headers.get("X-RateLimit-Remaining") == "0" and \
+       headers.get("X-RateLimit-Retry-After"):
+        try:
+            return max(0, float(headers["X-RateLimit-Retry-After"])
+                       - time.time())
+        except ValueError:
+            return None
+
+    return None
+
+
+# requests per second for each endpoint class, see set_rate_limits()
+_RATE_LIMITS = {"api": 5, "at-home": 40/60, "images": 0}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def set_rate_limits(api=None, at_home=None, images=None):
+    """
+    Set requests per second for API calls, at-home server lookups
+    and image fetches. Images are limited per host, 0 is unlimited.
+    """
+    for key, rate in (("api", api), ("at-home", at_home), ("images", images)):
+        if rate is not None:
+            _RATE_LIMITS[key] = rate
+
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def _get_limiter(url):
+    parts = urlsplit(url)
+
+    if parts.path.startswith(("/data/", "/data-saver/")):
+        key = ("images", parts.netloc)
+    elif parts.path.startswith("/at-home/"):
+        key = ("at-home", parts.netloc)
+    else:
+        key = ("api", parts.netloc)
 
-    @classmethod
-    def check(cls):
-        if len(cls.last_requests) == 5:
-            interval = time.time() - cls.last_requests[0]
-            if interval < 1:
-                time.sleep(1 - interval)
-        cls.last_requests.append(time.time())
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = _RateLimiter(_RATE_LIMITS[key[0]])
+        return _limiters[key]
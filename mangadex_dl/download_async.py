@@ -0,0 +1,352 @@
+"""
+Mangadex-dl: download_async.py
+Alternative download engine running every request on a single asyncio loop.
+Requires the optional aiohttp package.
+"""
+
+import time
+import asyncio
+import hashlib
+import logging
+import importlib.util
+from collections import deque
+
+from mangadex_dl import library
+from mangadex_dl import progress
+from mangadex_dl import download as dl
+from mangadex_dl.instance import SESSION
+
+MAX_CONNECTIONS = 200  # image requests in flight
+CHAPTER_WINDOW = 5     # chapters whose pages are queued at once
+
+
+def download_chapters(requested_chapters,
+                      out_directory,
+                      is_datasaver,
+                      gui={},
+                      callback=None,
+                      stream=None,
+                      resume=None,
+                      index=None):
+    """
+    Same as download.download_chapters, but on one thread.
+    In GUI mode gui["cancel"] cancels the download from any thread.
+    Returns the list of chapter directories.
+    """
+    if importlib.util.find_spec("aiohttp") is None:
+        raise ImportError("The async engine requires aiohttp. "
+                          "Install it with: pip install aiohttp")
+
+    with progress.reporting(gui) as bus:
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(_download_chapters(requested_chapters,
+                                                   out_directory,
+                                                   is_datasaver,
+                                                   bus,
+                                                   callback,
+                                                   stream,
+                                                   resume,
+                                                   index))
+        if gui.get("set"):
+            gui["cancel"] = lambda: loop.call_soon_threadsafe(task.cancel)
+
+        try:
+            return loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            logging.warning("Download cancelled")
+            return []
+        finally:
+            # the loop is closed, nothing is left to cancel
+            if gui.get("set"):
+                gui["cancel"] = None
+            loop.close()
+
+
+async def _download_chapters(requested_chapters, out_directory,
+                             is_datasaver, bus, callback, stream,
+                             resume, index):
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=120)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        chapter_count_max = len(requested_chapters)
+        chapter_directories = dl._find_resume_directories(out_directory,
+                                                          resume)
+        scheduled = deque()
+        directories = []
+        node_stats = dl._NodeStats()
+        is_own_index = index is None
+        if is_own_index:
+            index = library.open_index(out_directory.parent)
+        bus.put("reset")
+
+        servers = deque(asyncio.ensure_future(
+            _get_chapter_server(session, chapter.id))
+            for chapter in requested_chapters[:dl.CHAPTER_PREFETCH])
+
+        try:
+            for chapter_count, chapter in enumerate(requested_chapters,
+                                                    start=1):
+                prefetch_index = chapter_count - 1 + dl.CHAPTER_PREFETCH
+                if prefetch_index < chapter_count_max:
+                    servers.append(asyncio.ensure_future(_get_chapter_server(
+                        session, requested_chapters[prefetch_index].id)))
+
+                scheduled_chapter = _schedule_chapter(session,
+                                                      chapter,
+                                                      await servers.popleft(),
+                                                      out_directory,
+                                                      is_datasaver,
+                                                      chapter_directories,
+                                                      stream,
+                                                      node_stats)
+                scheduled.append((chapter, chapter_count, scheduled_chapter))
+                if scheduled_chapter:
+                    directories.append(scheduled_chapter[1])
+
+                if len(scheduled) > CHAPTER_WINDOW:
+                    await _wait_chapter(*scheduled.popleft(),
+                                        chapter_count_max, bus, index,
+                                        callback)
+
+            while scheduled:
+                await _wait_chapter(*scheduled.popleft(),
+                                    chapter_count_max, bus, index, callback)
+        finally:
+            # cancel everything left on error or cancellation
+            for task in servers:
+                task.cancel()
+            for _, _, scheduled_chapter in scheduled:
+                for task in (scheduled_chapter or [None, None, []])[2]:
+                    task.cancel()
+            if index and is_own_index:
+                index.close()
+
+    node_stats.log()
+    return directories
+
+
+async def _get_chapter_server(session, chapter_id):
+    return await _url_request(session,
+                              f"{dl.API_URL}/at-home/server/{chapter_id}",
+                              json=True)
+
+
+async def _get_chapter_server_safe(session, chapter_id):
+    try:
+        return await _get_chapter_server(session, chapter_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        return None
+
+
+def _schedule_chapter(session, chapter, chapter_json, out_directory,
+                      is_datasaver, chapter_directories, stream, node_stats):
+    prepared = dl._prepare_chapter(chapter, chapter_json, out_directory,
+                                   is_datasaver, chapter_directories, stream,
+                                   node_stats)
+    if prepared is None:
+        return None
+
+    server, directory_chapter, pages, writer = prepared
+    task_list = []
+
+    for image_count, image_name, is_done in pages:
+        if is_done:
+            task = asyncio.get_running_loop().create_future()
+            task.set_result(dl._get_page_record(directory_chapter,
+                                                image_count, image_name,
+                                                writer))
+        else:
+            task = asyncio.ensure_future(_download_image(session,
+                                                         server,
+                                                         image_name,
+                                                         image_count,
+                                                         directory_chapter,
+                                                         writer))
+        task_list.append(task)
+
+    return server, directory_chapter, task_list
+
+
+async def _wait_chapter(chapter, chapter_count, scheduled_chapter,
+                        chapter_count_max, bus, index, callback):
+    dl._report_chapter(chapter, chapter_count, chapter_count_max, bus)
+
+    if not scheduled_chapter:
+        dl._report_unavailable(chapter, bus)
+        if callback:
+            callback(chapter, None)
+        return
+
+    server, directory_chapter, task_list = scheduled_chapter
+    image_count_downloaded = 0
+    image_count_max = len(task_list)
+
+    for task in asyncio.as_completed(task_list):
+        page = await task
+        image_count_downloaded += 1
+        dl._report_page(image_count_downloaded, image_count_max, page, bus)
+
+    dl._report_chapter_done(bus)
+
+    if index:
+        dl._add_chapter_to_index(index, chapter, server, directory_chapter,
+                                 [task.result() for task in task_list])
+
+    if callback:
+        callback(chapter, directory_chapter)
+
+
+async def _download_image(session, server, image_name,
+                          image_count, directory_chapter, writer=None):
+
+    image_file_path = dl._get_image_path(directory_chapter,
+                                         image_count, image_name)
+
+    error = None
+    for i in range(dl.IMAGE_ATTEMPTS):
+        full_url = server.get_url(image_name)
+        start = time.monotonic()
+        try:
+            if writer:
+                size, cached, checksum = await _download_page(
+                    session, full_url, writer, image_count)
+            else:
+                size, cached, checksum = await _url_download(
+                    session, full_url, image_file_path,
+                    retry=dl.IMAGE_RETRY_POLICY)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            error = err
+            if server.report(full_url, False, 0, time.monotonic() - start):
+                server.switch(await _get_chapter_server_safe(
+                    session, server.chapter_id))
+            while server.switching:
+                # another page is already requesting a new node
+                await asyncio.sleep(0.2)
+            continue
+
+        node = server.get_node(full_url)
+        if server.report(full_url, True, size,
+                         time.monotonic() - start, cached):
+            server.switch(await _get_chapter_server_safe(
+                session, server.chapter_id))
+        return image_count, image_name, node, size, checksum
+
+    logging.error(f"File download failed ({image_file_path}): {error}")
+    if writer:
+        await asyncio.to_thread(writer.put, image_count, None)
+    return None
+
+
+async def _download_page(session, url, writer, image_count):
+    """Same as download._download_page."""
+    data, cached = await _url_request(session, url,
+                                      retry=dl.IMAGE_RETRY_POLICY,
+                                      cached=True)
+    await asyncio.to_thread(writer.put, image_count, data)
+    return len(data), cached, hashlib.sha256(data).hexdigest()
+
+
+async def _url_download(session, url, file_path, retry=None):
+    """Same as download.url_download."""
+    retry = retry or dl.RETRY_POLICY
+    deadline = time.monotonic() + retry.deadline
+
+    attempt = 0
+    while True:
+        try:
+            limiter = dl._get_limiter(url)
+            await asyncio.sleep(limiter.reserve())
+
+            async with session.get(url, proxy=_get_proxy(),
+                                   headers=dl._get_range_headers(file_path)
+                                   ) as r:
+                limiter.update(r.headers)
+                r.raise_for_status()
+
+                part_file = await asyncio.to_thread(
+                    dl._PartFile, file_path, r.status,
+                    r.headers.get("content-length"),
+                    r.headers.get("content-range"))
+                try:
+                    async for chunk in r.content.iter_chunked(dl.CHUNK_SIZE):
+                        await asyncio.to_thread(part_file.write, chunk)
+                    await asyncio.to_thread(part_file.commit)
+                finally:
+                    part_file.close()
+
+            return part_file.size, dl._is_cached(r.headers), \
+                part_file.sha256.hexdigest()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            status, headers = dl._get_error_status(err)
+            if dl._drop_stale_part(file_path, status):
+                continue
+
+            delay = retry.next_delay(attempt, status, headers, deadline)
+            if delay is None:
+                logging.error(f"URL Request: {err}")
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _url_request(session, url, params=None, json=False, retry=None,
+                       cached=False):
+    """With 'cached' returns the content and whether the node cached it."""
+    import aiohttp
+
+    retry = retry or dl.RETRY_POLICY
+    deadline = time.monotonic() + retry.deadline
+
+    for attempt in range(retry.attempts):
+        try:
+            limiter = dl._get_limiter(url)
+            await asyncio.sleep(limiter.reserve())
+
+            async with session.get(url, params=params,
+                                   proxy=_get_proxy()) as r:
+                limiter.update(r.headers)
+                r.raise_for_status()
+
+                if json:
+                    return await r.json(content_type=None)
+
+                response = await r.read()
+
+                content_length = r.headers.get("content-length")
+                received_bytes = len(response)
+
+                if content_length and received_bytes != int(content_length):
+                    raise aiohttp.ClientPayloadError(
+                        "IncompleteRead: "
+                        f"{received_bytes} from {content_length}")
+
+                if cached:
+                    return response, dl._is_cached(r.headers)
+                return response
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            delay = retry.next_delay(attempt, *dl._get_error_status(err),
+                                     deadline)
+            if delay is None:
+                logging.error(f"URL Request: {err}")
+                raise
+            await asyncio.sleep(delay)
+
+
+def _get_proxy():
+    """aiohttp supports only HTTP proxies, socks5 is ignored."""
+    proxy = SESSION.proxies.get("http")
+    if proxy and proxy.startswith("http"):
+        return proxy
+    return None
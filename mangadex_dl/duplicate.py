@@ -4,18 +4,22 @@ Sometimes chapters are duplicated by several scanlate groups,
 these functions allow you to filter out unnecessary ones.
 """
 
-from functools import lru_cache
-
 import mangadex_dl.download as dl
 
+PRIORITY_DEFAULT = 5  # priority of groups missing from the profile
+
 
 def resolve_duplicated_chapters(chapters_list,
                                 resolve,
-                                resolve_manual_function):
+                                resolve_manual_function,
+                                profile={},
+                                manga_uuid=None):
     """
     Returns a list of chapters based on the given argument 'resolve'.
     'resolve_manual_function' is required to manually specify
     the priority of groups in the console or in the GUI.
+    Group priorities of the 'profile' (see get_group_priority) are
+    applied with resolve="profile" and are the defaults with "manual".
     """
     if resolve == "all":
         return chapters_list
@@ -25,16 +29,10 @@ def resolve_duplicated_chapters(chapters_list,
         return chapters_list
 
     if resolve == "one":
-        for duplicates_set in duplicates_list:
-            first = True
-            for duplicate in duplicates_set:
-                if first:
-                    first = False
-                else:
-                    if duplicate in chapters_list:
-                        chapters_list.remove(duplicate)
-
-        return chapters_list
+        removed_id = {duplicate.id
+                      for duplicates_set in duplicates_list
+                      for duplicate in duplicates_set[1:]}
+        return _remove_chapters(chapters_list, removed_id)
 
     # manually set scanlate groups priority
     print("Receiving scanlate groups info...")
@@ -42,7 +40,16 @@ def resolve_duplicated_chapters(chapters_list,
     print(f"Duplicated chapters have {len(scanlation_groups)} scanlate groups")
 
     if len(scanlation_groups) == 0:
-        return
+        return chapters_list
+
+    for group in scanlation_groups:
+        group["priority"] = get_group_priority(profile, manga_uuid,
+                                               group["id"])
+
+    if resolve == "profile":
+        return resolve_scanlate_priority_function(chapters_list,
+                                                  duplicates_list,
+                                                  scanlation_groups)
 
     return resolve_manual_function(chapters_list,
                                    duplicates_list,
@@ -54,85 +61,104 @@ def get_duplicated_chapters(chapters_list):
     Return a nested list of duplicates like:
     [[chap1_1, chap1_2], [chap2_1, chap2_2, chap2_3]...]
     """
-    duplicates_list = []
     duplicates_dict = {}
 
     for chapter in chapters_list:
-        index = f"{chapter['attributes']['volume']}-{chapter['attributes']['chapter']}"
+        duplicates_dict.setdefault((chapter.volume, chapter.chapter),
+                                   []).append(chapter)
 
-        if index not in duplicates_dict:
-            duplicates_dict[index] = []
+    return [v for v in duplicates_dict.values() if len(v) > 1]
 
-        duplicates_dict[index].append(chapter)
 
-    for v in duplicates_dict.values():
-        if len(v) > 1:
-            duplicates_list.append(v)
-
-    return duplicates_list
+def get_scanlation_groups_from_duplicates(duplicates_list):
+    chapters_list = [duplicate
+                     for duplicates_set in duplicates_list
+                     for duplicate in duplicates_set]
+    return list(get_scanlation_groups(chapters_list).values())
 
 
-def get_scanlation_groups_from_duplicates(duplicates_list):
-    scanlation_groups_id = set()
-    scanlation_groups = []
+def get_scanlation_groups(chapters_list):
+    """
+    Return {group id: group JSON} of the chapters' scanlate groups.
+    Groups included in the feed are taken from it, the others are
+    requested 100 per request and their names are set on the chapters.
+    """
+    scanlation_groups = {}
+    missing_id = set()
 
-    for duplicates_set in duplicates_list:
-        for duplicate in duplicates_set:
-            group_id = get_chapter_scanlation_id(duplicate)
-            if group_id:
-                scanlation_groups_id.add(group_id)
+    for chapter in chapters_list:
+        if not chapter.group_id:
+            continue
+        if chapter.group_name is not None:
+            scanlation_groups[chapter.group_id] = {
+                "id": chapter.group_id,
+                "type": "scanlation_group",
+                "attributes": {"name": chapter.group_name}}
+        else:
+            missing_id.add(chapter.group_id)
+
+    missing_id = sorted(missing_id - scanlation_groups.keys())
+    for i in range(0, len(missing_id), 100):
+        res = dl.get_json(f"{dl.API_URL}/group",
+                          {"ids[]": missing_id[i:i+100], "limit": 100})
+        for group in res["data"]:
+            scanlation_groups[group["id"]] = group
 
-    for group_id in scanlation_groups_id:
-        scanlation_groups.append(get_scanlation_group_info(group_id))
+    for chapter in chapters_list:
+        if chapter.group_name is None and \
+           chapter.group_id in scanlation_groups:
+            chapter.group_name = \
+                scanlation_groups[chapter.group_id]["attributes"]["name"]
 
     return scanlation_groups
 
 
+def get_group_priority(profile, manga_uuid, group_id):
+    """
+    Return the priority of the group from the [priority] table of the
+    config: the manga's own table, then the global group priorities,
+    then "default" of the table, then PRIORITY_DEFAULT.
+    {"default": 5, "<group>": 1, "<manga>": {"<group>": 2}}
+    """
+    manga_profile = profile.get(manga_uuid)
+    if isinstance(manga_profile, dict) and group_id in manga_profile:
+        return int(manga_profile[group_id])
+
+    priority = profile.get(group_id)
+    if priority is not None and not isinstance(priority, dict):
+        return int(priority)
+
+    return int(profile.get("default", PRIORITY_DEFAULT))
+
+
 def resolve_scanlate_priority_function(chapters_list,
                                        duplicates_list,
                                        scanlation_groups):
     """
     Filter out duplicate chapters from low priority groups
-    in favor of higher priority groups.
-    Note: Every group in list should have ['priority'] parameter.
+    in favor of higher priority groups. Of groups with the same priority,
+    or if no group of the duplicates has one, the first chapter is kept.
+    Note: Every group in list should have ['priority'] parameter (1-5).
           It should be insert manually in resolve_manual_function.
-          The function also inserts the JSON scanlate group name
-          and priority into each duplicated chapter.
     """
-    scanlation_groups.sort(key=lambda x: x["priority"])
+    priorities = {group["id"]: int(group["priority"])
+                  for group in scanlation_groups}
+    removed_id = set()
 
     for duplicates_set in duplicates_list:
-        prior_chapter = None
+        prior_chapter = min((duplicate for duplicate in duplicates_set
+                             if duplicate.group_id in priorities),
+                            key=lambda x: priorities[x.group_id],
+                            default=duplicates_set[0])
 
-        for duplicate in duplicates_set:
-            duplicate_group_id = get_chapter_scanlation_id(duplicate)
+        removed_id.update(duplicate.id for duplicate in duplicates_set
+                          if duplicate is not prior_chapter)
 
-            for group in scanlation_groups:
-                if duplicate_group_id == group["id"]:
-                    duplicate["scanlate-name"] = group["attributes"]["name"]
-                    duplicate["scanlate-priority"] = group["priority"]
+    return _remove_chapters(chapters_list, removed_id)
 
-                    if not prior_chapter:
-                        prior_chapter = duplicate
-
-                    elif prior_chapter["scanlate-priority"] > duplicate["scanlate-priority"]:
-                        if prior_chapter in chapters_list:
-                            chapters_list.remove(prior_chapter)
-                        prior_chapter = duplicate
-
-        for duplicate in duplicates_set:
-            if duplicate != prior_chapter and duplicate in chapters_list:
-                chapters_list.remove(duplicate)
 
+def _remove_chapters(chapters_list, removed_id):
+    """Remove chapters by UUID in one pass, in place like list.remove."""
+    chapters_list[:] = [chapter for chapter in chapters_list
+                        if chapter.id not in removed_id]
     return chapters_list
-
-
-def get_chapter_scanlation_id(chapter):
-    for relation in chapter["relationships"]:
-        if relation["type"] == "scanlation_group":
-            return relation["id"]
-
-
-@lru_cache(maxsize=16)
-def get_scanlation_group_info(group_id):
-    return dl.get_json(f"https://api.mangadex.org/group/{group_id}")["data"]
@@ -8,13 +8,15 @@ from tkinter import ttk
 from tkinter import filedialog
 from tkinter import messagebox
 
-import json
+import bisect
 import traceback
 import concurrent.futures
 from pathlib import Path
 
 from mangadex_dl import utils
+from mangadex_dl import cache
 from mangadex_dl import parse
+from mangadex_dl import progress
 from mangadex_dl import archive as ar
 from mangadex_dl import download as dl
 from mangadex_dl import duplicate as dup
@@ -55,11 +57,16 @@ class _MangadexDlGui:
         self.status = StringVar(value="Enter a URL or search query in the searchbar")
         self.future = None
         self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        self.lib_options = {"set": True, "exit": False, "thread_pool": None,
-                            "progress_chapter": DoubleVar(value=0.0),
-                            "progress_page": DoubleVar(value=0.0),
-                            "progress_chapter_text": StringVar(value="[ - / - ]"),
-                            "progress_page_text": StringVar(value="[ - / - ]")}
+        # worker threads don't touch widgets, they put events into this bus
+        self.progress = progress.ProgressBus()
+        self.progress_state = progress.ProgressState()
+        self.progress_chapter = DoubleVar(value=0.0)
+        self.progress_page = DoubleVar(value=0.0)
+        self.progress_chapter_text = StringVar(value="[ - / - ]")
+        self.progress_page_text = StringVar(value="[ - / - ]")
+        self.progress_rate_text = StringVar(value="")
+        self.lib_options = {"set": True, "exit": False, "cancel": None,
+                            "progress": self.progress}
 
         # manga-relative vars
         self.manga_info = None
@@ -102,32 +109,77 @@ class _MangadexDlGui:
         statusbar = self.init_statusbar(self.root)
         statusbar.grid(column=0, row=1, sticky=(N, S, E, W), pady=self.padding, padx=self.padding)
 
+        self.poll_progress()
+
     ##########################
     #   FUNCTIONS SECTION    #
     ##########################
 
     def async_run(self, f, *args):
         if not self.block:
+            self.set_busy(True)
             self.future = self.thread_pool.submit(lambda: self.async_wrap(f, *args))
         else:
             messagebox.showinfo(message="Wait until the current operation completes.")
 
     def async_wrap(self, f, *args):
+        # runs in the worker thread, so widgets are changed through self.progress
         try:
-            self.block = True
-            self.set_interface_state(False)
-            self.indicator.start()
             f(*args)
         except Exception as e:
             print(traceback.format_exc())
-            self.status.set("Something went wrong! Please try again.")
-            messagebox.showinfo(message=f"Error: {e}")
+            self.set_status("Something went wrong! Please try again.")
+            self.progress.call(messagebox.showinfo, message=f"Error: {e}")
         finally:
             self.future = None
-            self.block = False
-            self.set_interface_state(True)
+            self.progress.call(self.set_busy, False)
+
+    def set_busy(self, busy):
+        self.block = busy
+        self.set_interface_state(not busy)
+        if busy:
+            self.indicator.start()
+        else:
             self.indicator.stop()
 
+    def set_status(self, text):
+        # safe to call from the worker thread
+        self.progress.put("status", text=text)
+
+    def poll_progress(self):
+        # drains the events of the worker thread FRAME_RATE times per second
+        self.root.after(1000 // progress.FRAME_RATE, self.poll_progress)
+
+        for kind, values in self.progress.drain():
+            if kind == "call":
+                values["function"]()
+            elif kind == "status":
+                self.status.set(values["text"])
+            elif kind == "archived":
+                self.status.set(f"Archived {values['name']}")
+            else:
+                self.progress_state.apply(kind, values)
+
+        self.update_progress()
+
+    def update_progress(self):
+        state = self.progress_state
+        if state.archive_total:
+            count, total = state.archived, state.archive_total
+        else:
+            count, total = state.chapter, state.chapter_total
+
+        values = ((self.progress_chapter, (count / total) * 100 if total else 0),
+                  (self.progress_chapter_text, f"[ {count} / {total} ]" if total else "[ - / - ]"),
+                  (self.progress_page, (state.page / state.page_total) * 100 if state.page_total else 0),
+                  (self.progress_page_text, f"[ {state.page} / {state.page_total} ]" if state.page_total else "[ - / - ]"),
+                  (self.progress_rate_text, state.get_rate_text()))
+
+        # setting an unchanged variable still redraws the widgets
+        for var, value in values:
+            if var.get() != value:
+                var.set(value)
+
     def set_interface_state(self, state=True):
         frames = [self.tab_settings, self.tab_search, self.tab_scanlate, self.tab_download]
         for frame in frames:
@@ -167,7 +219,11 @@ class _MangadexDlGui:
     def resolve_duplicates_manual_gui(self, chapters_list, duplicated_chapters_list, scanlation_groups):
         self.duplicated_chapters_list = duplicated_chapters_list
         self.scanlation_groups = scanlation_groups
-        self.scanlation_groups_priority = [StringVar(value="5") for i in self.scanlation_groups]
+        self.progress.call(self.init_resolve_gui)
+        return chapters_list
+
+    def init_resolve_gui(self):
+        self.scanlation_groups_priority = [StringVar(value=str(group["priority"])) for group in self.scanlation_groups]
 
         self.destroy_resolve_gui()
 
@@ -188,100 +244,53 @@ class _MangadexDlGui:
         button = ttk.Button(self.tab_scanlate, text="Apply", command=self.cb_resolve_duplicates)
         button.grid(column=1, row=0, sticky=(E), pady=self.padding, padx=self.padding)
 
-        return chapters_list
-
     def destroy_resolve_gui(self):
         for widget in self.tab_scanlate.winfo_children():
             widget.destroy()
 
     def get_chapters_list(self):
-        return utils.get_chapters_list(self.manga_info.uuid, self.args.language.get())
+        def callback(received, total):
+            self.set_status(f"Receiving available chapters [ {received} / {total} ]...")
+        return utils.get_chapters_list(self.manga_info.uuid, self.args.language.get(), callback=callback)
 
     def update_search_results_list(self):
         name_list = [f"{manga.title} ({manga.year}) by {', '.join(manga.authors)}" for manga in self.manga_list_found]
         self.manga_list_found_var.set(name_list)
 
-    def load_tree_chapters(self):
-        # Each volume in the tree is open by default.
-        # Tkinter does not provide a way to automatically update
-        # the list along with the tree or a way to keep open volumes between trees.
-        # Doing it manually is fraught with a bunch of synchronization errors and others,
-        # and is generally not worth the time.
-        self.chapters_list.sort(key=self.sort_chapters_list_key)
-        self.chapters_list_selected.sort(key=self.sort_chapters_list_key)
+    def get_group_names(self):
+        # sets the names of groups not included in the feed
+        if self.args.resolve.get() != "one":
+            dup.get_scanlation_groups([c for c in self.chapters_list + self.chapters_list_selected if c.group_name is None])
 
-        self.load_tree(self.tree_a, self.chapters_list)
-        self.load_tree(self.tree_b, self.chapters_list_selected)
+    def load_tree_chapters(self):
+        # Rebuilds both trees, used when the lists are replaced.
+        # Moving chapters between the trees updates only their rows.
+        show_group = self.args.resolve.get() != "one"
+        self.tree_a.load(self.chapters_list, show_group)
+        self.tree_b.load(self.chapters_list_selected, show_group)
+        self.update_chapters_len()
+
+    def clear_chapters_gui(self):
+        self.destroy_resolve_gui()
+        self.tree_a.clear()
+        self.tree_b.clear()
+        self.chapters_len_available.set("Available chapters")
+        self.chapters_len_download.set("Chapters to download")
 
+    def update_chapters_len(self):
         self.chapters_len_available.set(f"Available chapters: {len(self.chapters_list)}")
         self.chapters_len_download.set(f"Chapters to download: {len(self.chapters_list_selected)}")
 
-    def load_tree(self, tree, array):
-        """
-        Note: This function modifies the given array.
-        Adds text value to each chapter dict:
-        ['volume'], ['chapter'] and ['scanlate_name']
-        """
-        self.clear_tree(tree)
-
-        volume_name = None
-        for chapter in array:
-            c_v = chapter["attributes"]["volume"] or "Unknown"
-            c_n = chapter["attributes"]["chapter"] or "Oneshot"
-            c_t = chapter["attributes"]["title"] or ""
-
-            chapter_volume = f"Volume {c_v}"
-            chapter_name = f"Chapter {c_n}"
-            chapter_title = f"{chapter_name} {c_t}"
-
-            if self.args.resolve.get() != "one":
-                if "scanlate_name" not in chapter:
-                    scanlate_id = dup.get_chapter_scanlation_id(chapter)
-                    if scanlate_id:
-                        scanlate_json = dup.get_scanlation_group_info(scanlate_id)
-                        chapter["scanlate_name"] = scanlate_json["attributes"]["name"]
-                    else:
-                        chapter["scanlate_name"] = "No Scanlate Group"
-                chapter_title += f" [{chapter['scanlate_name']}]"
-
-            chapter["volume"] = chapter_volume
-            chapter["chapter"] = chapter_name
-            if volume_name != chapter_volume:
-                volume_name = chapter_volume
-                tree.insert("", "end", volume_name, text=volume_name, values=("volume", json.dumps(chapter)))
-                tree.item(volume_name, open=True)
-            tree.insert(volume_name, "end", text=chapter_title, values=("chapter", json.dumps(chapter)))
-
-    def tree_item_move(self, tree_a, tree_b, list_a, list_b, item):
-        item_type = item["values"][0]
-        item_chap = json.loads(item["values"][1])
-
-        if item_type == "volume":
-            target_volume = item_chap["volume"]
-            selected_list = []
-
-            for chapter in list_a:
-                if chapter["volume"] == target_volume:
-                    selected_list.append(chapter)
-            for chapter in selected_list:
-                list_a.remove(chapter)
-                list_b.append(chapter)
-
-        elif item_type == "chapter":
-            list_a.remove(item_chap)
-            list_b.append(item_chap)
-
-        self.load_tree_chapters()
+    def tree_item_move(self, tree_a, tree_b, list_a, list_b, item_id):
+        moved_list = tree_a.get_chapters(item_id)
+        moved_id = {chapter.id for chapter in moved_list}
 
-    def clear_tree(self, tree):
-        tree.delete(*tree.get_children())
+        list_a[:] = [chapter for chapter in list_a if chapter.id not in moved_id]
+        list_b += moved_list
 
-    def sort_chapters_list_key(self, chapter):
-        c_v = chapter["attributes"]["volume"] or 0.0
-        c_c = chapter["attributes"]["chapter"] or 0.0
-        option_a = float(c_v)
-        option_b = float(c_c)
-        return (option_a, option_b)
+        tree_a.remove(moved_list)
+        tree_b.insert(moved_list, self.args.resolve.get() != "one")
+        self.update_chapters_len()
 
     def convert_args_to_stringvar(self, args):
         # tk doesnt support python's types like None, so convert to string
@@ -301,11 +310,12 @@ class _MangadexDlGui:
     def cb_on_closing(self):
         try:
             self.thread_pool.shutdown(wait=False, cancel_futures=True)
-            if self.lib_options["thread_pool"]:
-                self.lib_options["thread_pool"].shutdown(wait=False, cancel_futures=True)
-            self.root.destroy()
+            if self.lib_options["cancel"]:
+                self.lib_options["cancel"]()
+            cache.log_stats()
         except Exception:
             pass
+        self.root.destroy()
 
     def cb_search_result_select(self, e):
         if e:
@@ -315,52 +325,49 @@ class _MangadexDlGui:
 
     def cb_get_manga_info(self):
         if not self.manga_url.get():
-            messagebox.showinfo(message="Paste the URL first.\nChange to the English keyboard layout if you cannot paste text.")
+            self.progress.call(messagebox.showinfo, message="Paste the URL first.\nChange to the English keyboard layout if you cannot paste text.")
             return
 
         # clearing old results
-        self.destroy_resolve_gui()
-        self.clear_tree(self.tree_a)
-        self.clear_tree(self.tree_b)
         self.chapters_list = []
         self.chapters_list_selected = []
-        self.chapters_len_available.set("Available chapters")
-        self.chapters_len_download.set("Chapters to download")
+        self.progress.call(self.clear_chapters_gui)
 
         # start downloading
-        self.status.set("Receiving manga's info...")
+        self.set_status("Receiving manga's info...")
 
         if not utils.get_uuid(self.manga_url.get()):
             self.manga_list_found = utils.search_manga(self.manga_url.get(), self.args.language.get())
             if not self.manga_list_found:
-                self.status.set("Nothing was found according to your request")
+                self.set_status("Nothing was found according to your request")
             else:
-                self.status.set("Select title and search again")
-            self.update_search_results_list()
+                self.set_status("Select title and search again")
+            self.progress.call(self.update_search_results_list)
             return
 
         self.manga_info = utils.get_manga_info(self.manga_url.get(), self.args.language.get())
         self.manga_preview_info = self.manga_info
-        self.update_manga_info()
+        self.progress.call(self.update_manga_info)
 
-        self.status.set("Receiving available chapters...")
+        self.set_status("Receiving available chapters...")
         self.chapters_list = self.get_chapters_list()
 
-        self.status.set("Resolving duplicated chapters...")
-        self.chapters_list = dup.resolve_duplicated_chapters(self.chapters_list, self.args.resolve.get(), self.resolve_duplicates_manual_gui)
+        self.set_status("Resolving duplicated chapters...")
+        self.chapters_list = dup.resolve_duplicated_chapters(self.chapters_list, self.args.resolve.get(), self.resolve_duplicates_manual_gui,
+                                                             self.args.priority, self.manga_info.uuid)
 
         if self.args.download.get() != "False":
-            self.status.set("Parsing download range...")
+            self.set_status("Parsing download range...")
             dl_list = parse.parse_range(self.args.download.get())
             self.chapters_list_selected = parse.get_requested_chapters(self.chapters_list, dl_list)
-            for chapter in self.chapters_list_selected:
-                if chapter in self.chapters_list:
-                    self.chapters_list.remove(chapter)
+            selected_id = {chapter.id for chapter in self.chapters_list_selected}
+            self.chapters_list = [chapter for chapter in self.chapters_list if chapter.id not in selected_id]
 
-        self.status.set("Updating chapters tree...")
-        self.load_tree_chapters()
+        self.set_status("Updating chapters tree...")
+        self.get_group_names()
+        self.progress.call(self.load_tree_chapters)
 
-        self.status.set("Manga info received")
+        self.set_status("Manga info received")
 
     def cb_save_settings(self):
         with open(Path("config.toml"), "rb") as f:
@@ -404,9 +411,9 @@ class _MangadexDlGui:
         if self.block:
             messagebox.showinfo(message="Wait for the download to complete.")
             return
-        item = tree_a.item(tree_a.focus())
-        if not isinstance(item["open"], bool) and item["text"] != "":
-            self.tree_item_move(tree_a, tree_b, list_a, list_b, item)
+        item_id = tree_a.tree.focus()
+        if item_id:
+            self.tree_item_move(tree_a, tree_b, list_a, list_b, item_id)
 
     def cb_move_all_to_selected(self):
         self.chapters_list_selected += self.chapters_list
@@ -415,34 +422,51 @@ class _MangadexDlGui:
 
     def cb_download_chapters(self):
         if not self.chapters_list_selected:
-            messagebox.showinfo(message="First click on chapters from the list on the left to move them to the download list.")
+            self.progress.call(messagebox.showinfo, message="First click on chapters from the list on the left to move them to the download list.")
             return
 
-        self.status.set("Downloading started...")
+        self.set_status("Downloading started...")
 
         manga_directory = utils.create_manga_directory(Path(self.args.outdir.get()),
                                                        self.manga_info.title_en,
                                                        self.manga_info.uuid)
-        dl.download_chapters(self.chapters_list_selected,
-                             manga_directory,
-                             self.args.datasaver.get(),
-                             self.lib_options)
-
-        if self.args.archive.get() != "False":
-            self.lib_options["progress_chapter"].set(0)
-            self.lib_options["progress_page"].set(0)
-            self.lib_options["progress_chapter_text"].set("[ - / - ]")
-            self.lib_options["progress_page_text"].set("[ - / - ]")
-            self.status.set("Archive downloaded chapters...")
-            ar.archive_manga(manga_directory, self.args.archive.get(),
-                             self.args.keep.get(), self.args.ext.get(), self.lib_options)
-
-        self.lib_options["progress_chapter"].set(0)
-        self.lib_options["progress_page"].set(0)
-        self.lib_options["progress_chapter_text"].set("[ - / - ]")
-        self.lib_options["progress_page_text"].set("[ - / - ]")
-
-        self.status.set("Manga was downloaded {}successfully".format("and archived " if self.args.archive.get() != "False" else ""))
+        self.chapters_list_selected.sort(key=lambda chapter: chapter.sort_key)
+
+        pipeline = None
+        stream = None
+        if self.args.archive.get() != "False" and self.args.stream and self.args.ext.get() != "pdf":
+            # pages are written straight into the archives
+            stream = ar.ZipStream(manga_directory, self.args.archive.get(), self.args.ext.get())
+        elif self.args.archive.get() != "False" and self.args.pipeline:
+            # archive chapters and volumes as soon as they are downloaded
+            pipeline = ar.ArchivePipeline(manga_directory, self.chapters_list_selected, self.args.archive.get(),
+                                          self.args.keep.get(), self.args.ext.get(), self.lib_options)
+
+        try:
+            dl.get_engine(self.args.engine).download_chapters(self.chapters_list_selected,
+                                                              manga_directory,
+                                                              self.args.datasaver.get(),
+                                                              self.lib_options,
+                                                              callback=pipeline and pipeline.add,
+                                                              stream=stream)
+        finally:
+            if stream:
+                stream.close()
+            if pipeline:
+                pipeline.close()
+
+        if self.args.archive.get() != "False" and not stream:
+            self.progress.put("reset")
+            self.set_status("Archive downloaded chapters...")
+            if pipeline:
+                pipeline.join()
+            else:
+                ar.archive_manga(manga_directory, self.args.archive.get(),
+                                 self.args.keep.get(), self.args.ext.get(), self.lib_options)
+
+        self.progress.put("reset")
+
+        self.set_status("Manga was downloaded {}successfully".format("and archived " if self.args.archive.get() != "False" else ""))
 
     def cb_show_help(self):
         help_str = "1. Check Settings tab. The settings are applied immediately when changed, but the old search results are preserved.\n"\
@@ -546,10 +570,12 @@ class _MangadexDlGui:
         radio_resolve_a = ttk.Radiobutton(frame, text="Display all", variable=self.args.resolve, value="all")
         radio_resolve_b = ttk.Radiobutton(frame, text="Display only one", variable=self.args.resolve, value="one")
         radio_resolve_c = ttk.Radiobutton(frame, text="Filter manually", variable=self.args.resolve, value="manual")
+        radio_resolve_d = ttk.Radiobutton(frame, text="Use group profile", variable=self.args.resolve, value="profile")
 
         radio_resolve_a.grid(column=1, row=14, sticky=(W), pady=self.padding, padx=self.padding)
         radio_resolve_b.grid(column=1, row=15, sticky=(W), pady=self.padding, padx=self.padding)
         radio_resolve_c.grid(column=2, row=14, sticky=(W), pady=self.padding, padx=self.padding)
+        radio_resolve_d.grid(column=2, row=15, sticky=(W), pady=self.padding, padx=self.padding)
 
         separator7 = ttk.Separator(frame, orient=HORIZONTAL)
         separator7.grid(column=0, row=16, columnspan=5, sticky=(W, E))
@@ -627,24 +653,24 @@ class _MangadexDlGui:
         label_b.grid(column=2, row=0, pady=self.padding, padx=self.padding)
 
         # trees
-        self.tree_a = ttk.Treeview(frame)
-        self.tree_a.grid(column=0, row=1, sticky=(N, S, E, W), pady=self.padding, padx=self.padding)
+        self.tree_a = _ChapterTree(ttk.Treeview(frame))
+        self.tree_a.tree.grid(column=0, row=1, sticky=(N, S, E, W), pady=self.padding, padx=self.padding)
 
-        self.tree_b = ttk.Treeview(frame)
-        self.tree_b.grid(column=2, row=1, sticky=(N, S, E, W), pady=self.padding, padx=self.padding)
+        self.tree_b = _ChapterTree(ttk.Treeview(frame))
+        self.tree_b.tree.grid(column=2, row=1, sticky=(N, S, E, W), pady=self.padding, padx=self.padding)
 
-        scrollbar_a = ttk.Scrollbar(frame, orient=VERTICAL, command=self.tree_a.yview)
+        scrollbar_a = ttk.Scrollbar(frame, orient=VERTICAL, command=self.tree_a.tree.yview)
         scrollbar_a.grid(column=1, row=1, sticky=(N, S))
 
-        scrollbar_b = ttk.Scrollbar(frame, orient=VERTICAL, command=self.tree_b.yview)
+        scrollbar_b = ttk.Scrollbar(frame, orient=VERTICAL, command=self.tree_b.tree.yview)
         scrollbar_b.grid(column=3, row=1, sticky=(N, S))
 
-        self.tree_a.configure(yscrollcommand=scrollbar_a.set)
-        self.tree_b.configure(yscrollcommand=scrollbar_b.set)
+        self.tree_a.tree.configure(yscrollcommand=scrollbar_a.set)
+        self.tree_b.tree.configure(yscrollcommand=scrollbar_b.set)
 
-        self.tree_a.bind("<ButtonRelease-1>", lambda x: self.cb_tree_item_move(self.tree_a, self.tree_b,
+        self.tree_a.tree.bind("<ButtonRelease-1>", lambda x: self.cb_tree_item_move(self.tree_a, self.tree_b,
                                                                                self.chapters_list, self.chapters_list_selected))
-        self.tree_b.bind("<ButtonRelease-1>", lambda x: self.cb_tree_item_move(self.tree_b, self.tree_a,
+        self.tree_b.tree.bind("<ButtonRelease-1>", lambda x: self.cb_tree_item_move(self.tree_b, self.tree_a,
                                                                                self.chapters_list_selected, self.chapters_list))
 
         # action bar
@@ -673,7 +699,7 @@ class _MangadexDlGui:
         frame.rowconfigure(2, weight=0)  # status text
         frame.columnconfigure(0, weight=0)  # progressbar labels
         frame.columnconfigure(1, weight=1)  # progressbar, status
-        frame.columnconfigure(2, weight=0)  # progress numbers
+        frame.columnconfigure(2, weight=0)  # progress numbers, speed and ETA
         frame.grid_columnconfigure(2, minsize=90)
         frame.columnconfigure(3, weight=0)  # separator
         frame.columnconfigure(4, weight=0)  # indicator, help button
@@ -688,20 +714,23 @@ class _MangadexDlGui:
         label_c = ttk.Label(frame, text="Status: ")
         label_c.grid(column=0, row=2, sticky=(E), pady=self.padding, padx=self.padding)
         ###
-        progressbar_chap = ttk.Progressbar(frame, orient=HORIZONTAL, mode="determinate", variable=self.lib_options["progress_chapter"])
+        progressbar_chap = ttk.Progressbar(frame, orient=HORIZONTAL, mode="determinate", variable=self.progress_chapter)
         progressbar_chap.grid(column=1, row=0, sticky=(E, W), pady=self.padding, padx=self.padding)
 
-        progressbar_page = ttk.Progressbar(frame, orient=HORIZONTAL, mode="determinate", variable=self.lib_options["progress_page"])
+        progressbar_page = ttk.Progressbar(frame, orient=HORIZONTAL, mode="determinate", variable=self.progress_page)
         progressbar_page.grid(column=1, row=1, sticky=(E, W), pady=self.padding, padx=self.padding)
 
         status = ttk.Label(frame, textvariable=self.status)
         status.grid(column=1, row=2, sticky=(W), pady=self.padding, padx=self.padding)
         ###
-        progress_chapter_text = ttk.Label(frame, textvariable=self.lib_options["progress_chapter_text"])
+        progress_chapter_text = ttk.Label(frame, textvariable=self.progress_chapter_text)
         progress_chapter_text.grid(column=2, row=0, sticky=(E, W), pady=self.padding, padx=self.padding)
 
-        progress_page_text = ttk.Label(frame, textvariable=self.lib_options["progress_page_text"])
+        progress_page_text = ttk.Label(frame, textvariable=self.progress_page_text)
         progress_page_text.grid(column=2, row=1, sticky=(E, W), pady=self.padding, padx=self.padding)
+
+        progress_rate_text = ttk.Label(frame, textvariable=self.progress_rate_text)
+        progress_rate_text.grid(column=2, row=2, sticky=(E, W), pady=self.padding, padx=self.padding)
         ###
         separator = ttk.Separator(frame, orient=VERTICAL)
         separator.grid(column=3, row=0, rowspan=3, sticky=(N, S))
@@ -714,3 +743,79 @@ class _MangadexDlGui:
         ###
 
         return frame
+
+
+class _ChapterTree:
+    """
+    Treeview of chapters sorted by volume and chapter number.
+    Chapter rows are keyed by the chapter UUID and volume rows
+    by "Volume <name>", so rows are inserted and removed one by one
+    and the other volumes keep their open state. The order of the rows
+    is kept in sorted lists, so Tk isn't asked for it on every row.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.chapters = {}  # chapter UUID -> Chapter
+        self.volumes = []  # sorted (volume key, volume row)
+        self.volume_rows = {}  # volume row -> sorted (sort key, chapter UUID)
+
+    def clear(self):
+        self.tree.delete(*self.tree.get_children())
+        self.chapters = {}
+        self.volumes = []
+        self.volume_rows = {}
+
+    def load(self, chapters_list, show_group):
+        self.clear()
+        self.insert(chapters_list, show_group)
+
+    def insert(self, chapters_list, show_group):
+        for chapter in sorted(chapters_list, key=lambda chapter: chapter.sort_key):
+            volume_id = self.insert_volume(chapter)
+
+            # rows are inserted in order, so new ones mostly go to the end
+            rows = self.volume_rows[volume_id]
+            row = (chapter.sort_key, chapter.id)
+            position = bisect.bisect(rows, row)
+            rows.insert(position, row)
+
+            title = f"Chapter {chapter.chapter_name} {chapter.title}"
+            if show_group:
+                title += f" [{chapter.group_name or 'No Scanlate Group'}]"
+
+            self.tree.insert(volume_id, "end" if position == len(rows) - 1 else position,
+                             chapter.id, text=title)
+            self.chapters[chapter.id] = chapter
+
+    def insert_volume(self, chapter):
+        volume_id = f"Volume {chapter.volume_name}"
+        if volume_id in self.volume_rows:
+            return volume_id
+
+        volume = (chapter.volume_key, volume_id)
+        position = bisect.bisect(self.volumes, volume)
+        self.volumes.insert(position, volume)
+
+        self.tree.insert("", position, volume_id, text=volume_id, open=True)
+        self.volume_rows[volume_id] = []
+        return volume_id
+
+    def remove(self, chapters_list):
+        for chapter in chapters_list:
+            volume_id = f"Volume {chapter.volume_name}"
+            rows = self.volume_rows[volume_id]
+            del rows[bisect.bisect_left(rows, (chapter.sort_key, chapter.id))]
+            self.tree.delete(chapter.id)
+            del self.chapters[chapter.id]
+
+            if not rows:
+                self.tree.delete(volume_id)
+                del self.volume_rows[volume_id]
+                self.volumes.remove((chapter.volume_key, volume_id))
+
+    def get_chapters(self, item_id):
+        """Return the chapter of the row or all chapters of the volume."""
+        if item_id in self.chapters:
+            return [self.chapters[item_id]]
+        return [self.chapters[row] for row in self.tree.get_children(item_id)]
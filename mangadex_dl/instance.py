@@ -12,6 +12,26 @@ from requests import Session
 
 SESSION = Session()
 
+# keys added after the first release, an older config.toml may lack them
+DEFAULTS = {
+    "engine": "thread",
+    "rate_api": 5,
+    "rate_at_home": 0.66,
+    "rate_images": 0,
+    "report": False,
+    "fsync": False,
+    "resume": False,
+    "index": False,
+    "cache": False,
+    "cache_size": 32,
+    "archive_workers": 0,
+    "pdf_compress": True,
+    "pipeline": False,
+    "stream": False,
+    "priority": {},
+    "api_url": "https://api.mangadex.org",
+}
+
 
 def init():
     """Initialize mangadex_dl."""
@@ -19,7 +39,7 @@ def init():
     logging.basicConfig(format="[%(levelname)s] (%(filename)s): %(message)s")
     config_file = Path("config.toml")
 
-    args_cfg = _parse_config(config_file)
+    args_cfg = DEFAULTS | _parse_config(config_file)
     args_cmd = _parse_args()
     args_cfg.update(args_cmd)
 
@@ -37,10 +57,28 @@ def init():
             "https": f"socks5://{args.socks}"
         }
 
+    from mangadex_dl import download
+    download.set_rate_limits(args.rate_api, args.rate_at_home, args.rate_images)
+    download.REPORT_NODES = args.report
+    download.FSYNC = args.fsync
+    download.RESUME = args.resume
+    download.API_URL = args.api_url.rstrip("/")
+
+    from mangadex_dl import library
+    library.ENABLED = args.index
+
+    from mangadex_dl import cache
+    cache.ENABLED = args.cache
+    cache.MAX_SIZE = args.cache_size * 1024 * 1024
+
+    from mangadex_dl import archive
+    archive.WORKERS = args.archive_workers
+    archive.PDF_COMPRESS = args.pdf_compress
+
     if args.archive_mode:
         from mangadex_dl.archive import init_archive_mode
         init_archive_mode(args)
-    elif args.gui:
+    elif args.gui and not (args.sync or args.watchlist or args.verify):
         from mangadex_dl.gui import init_gui
         init_gui(args)
     else:
@@ -71,5 +109,11 @@ def _parse_args():
                    help="specify manga url")
     p.add_argument("-a", "--archive-mode", action="store_true",
                    help="archiving mode")
+    p.add_argument("-s", "--sync", action="store_true",
+                   help="download only new and updated chapters")
+    p.add_argument("-w", "--watchlist", metavar="<file>",
+                   help="sync every manga listed in the file")
+    p.add_argument("--verify", action="store_true",
+                   help="check downloaded chapters against the library index")
 
     return vars(p.parse_args())
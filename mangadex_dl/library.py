@@ -0,0 +1,245 @@
+"""
+Mangadex-dl: library.py
+SQLite index of downloaded chapters, pages and archives.
+The index is kept in the output directory next to the manga directories.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+from mangadex_dl.models import Chapter
+
+ENABLED = False
+INDEX_NAME = "mangadex-dl.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    chapter_id    TEXT PRIMARY KEY,
+    manga_id      TEXT,
+    volume        TEXT,
+    chapter       TEXT,
+    directory     TEXT,
+    hash          TEXT,
+    pages         INTEGER,
+    updated_at    TEXT,
+    downloaded_at TEXT,
+    archive       TEXT
+);
+CREATE INDEX IF NOT EXISTS chapters_manga ON chapters (manga_id);
+
+CREATE TABLE IF NOT EXISTS pages (
+    chapter_id TEXT,
+    page       INTEGER,
+    filename   TEXT,
+    node       TEXT,
+    size       INTEGER,
+    checksum   TEXT,
+    PRIMARY KEY (chapter_id, page)
+);
+
+CREATE TABLE IF NOT EXISTS sync (
+    manga_id       TEXT,
+    language       TEXT,
+    updated_at     TEXT,
+    latest_chapter TEXT,
+    PRIMARY KEY (manga_id, language)
+);
+
+CREATE TABLE IF NOT EXISTS archives (
+    path       TEXT PRIMARY KEY,
+    manga_id   TEXT,
+    directory  TEXT,
+    mode       TEXT,
+    ext        TEXT,
+    size       INTEGER,
+    created_at TEXT
+);
+"""
+
+
+def open_index(library_dir: Path, force: bool = False):
+    """
+    Return the index of the output directory or None
+    if the index is disabled in the config and not forced.
+    """
+    if not (ENABLED or force):
+        return None
+    return LibraryIndex(Path(library_dir) / INDEX_NAME)
+
+
+class LibraryIndex:
+    """
+    Every public method runs in its own transaction, so the index
+    can be shared by download threads and the archiving code.
+    """
+
+    def __init__(self, path: Path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def add_chapter(self, chapter: Chapter, directory: Path, chapter_hash: str,
+                    page_count: int, pages: list[tuple]) -> None:
+        """
+        Record a downloaded chapter and its pages as
+        (page, filename, node, size, checksum) in one transaction.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO chapters VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                (chapter.id,
+                 chapter.manga_id,
+                 chapter.volume,
+                 chapter.chapter,
+                 str(directory),
+                 chapter_hash,
+                 page_count,
+                 chapter.updated_at,
+                 _now()))
+            self.db.execute("DELETE FROM pages WHERE chapter_id = ?",
+                            (chapter.id,))
+            self.db.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                [(chapter.id, *page) for page in pages])
+
+    def add_archive(self, path: Path, directory: Path,
+                    mode: str, ext: str) -> None:
+        """Record an archive and link the chapters it was made from."""
+        prefix = str(directory)
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE chapters SET archive = ? "
+                "WHERE directory = ? OR substr(directory, 1, ?) = ?",
+                (str(path), prefix, len(prefix) + 1, prefix + os.sep))
+            manga_id = self.db.execute(
+                "SELECT manga_id FROM chapters WHERE archive = ? LIMIT 1",
+                (str(path),)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(path),
+                 manga_id[0] if manga_id else None,
+                 prefix,
+                 mode,
+                 ext,
+                 path.stat().st_size if path.is_file() else None,
+                 _now()))
+
+    def get_chapters(self, manga_id: str) -> dict:
+        """Return {chapter uuid: updatedAt} of the downloaded chapters."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT chapter_id, updated_at FROM chapters "
+                "WHERE manga_id = ?", (manga_id,)).fetchall()
+        return dict(rows)
+
+    def get_incomplete_chapters(self, manga_id: str) -> dict:
+        """
+        Return {chapter uuid: updatedAt} of the chapters
+        with fewer recorded pages than the chapter has.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT c.chapter_id, c.updated_at FROM chapters c "
+                "LEFT JOIN pages p USING (chapter_id) WHERE c.manga_id = ? "
+                "GROUP BY c.chapter_id HAVING count(p.page) < c.pages",
+                (manga_id,)).fetchall()
+        return dict(rows)
+
+    def get_chapter_numbers(self, manga_id: str) -> set[tuple]:
+        """Return (volume, chapter) pairs of the downloaded chapters."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT volume, chapter FROM chapters WHERE manga_id = ?",
+                (manga_id,)).fetchall()
+        return set(rows)
+
+    def get_sync_mark(self, manga_id: str, language: str) -> str | None:
+        """Return updatedAt of the newest chapter seen by the last sync."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT updated_at FROM sync "
+                "WHERE manga_id = ? AND language = ?",
+                (manga_id, language)).fetchone()
+        return row[0] if row else None
+
+    def get_latest_chapter(self, manga_id: str, language: str) -> str | None:
+        """Return manga's latestUploadedChapter seen by the last sync."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT latest_chapter FROM sync "
+                "WHERE manga_id = ? AND language = ?",
+                (manga_id, language)).fetchone()
+        return row[0] if row else None
+
+    def set_sync_mark(self, manga_id: str, language: str, updated_at: str,
+                      latest_chapter: str | None = None) -> None:
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)",
+                            (manga_id, language, updated_at, latest_chapter))
+
+    def verify(self, manga_id: str | None = None) -> dict:
+        """
+        Return {chapter uuid: directory} of chapters whose pages are
+        missing or have another size than recorded, of one manga or of
+        the whole index. Archived chapters are checked by the archive.
+        """
+        where = "WHERE c.manga_id = ?" if manga_id else ""
+        params = (manga_id,) if manga_id else ()
+        with self.lock:
+            chapters = self.db.execute(
+                "SELECT chapter_id, directory, pages, archive FROM chapters c "
+                + where, params).fetchall()
+            pages = self.db.execute(
+                "SELECT p.chapter_id, p.page, p.filename, p.size "
+                "FROM pages p JOIN chapters c USING (chapter_id) "
+                + where, params).fetchall()
+
+        chapter_pages = {}
+        for chapter_id, page, filename, size in pages:
+            chapter_pages.setdefault(chapter_id, []).append(
+                (page, filename, size))
+
+        broken = {}
+        for chapter_id, directory, page_count, archive in chapters:
+            if archive and Path(archive).is_file():
+                continue
+
+            recorded = chapter_pages.get(chapter_id, [])
+            if len(recorded) != page_count:
+                broken[chapter_id] = directory
+                continue
+
+            for page, filename, size in recorded:
+                file_path = Path(directory) / "{:03d}{}".format(
+                    page, Path(filename).suffix)
+                if not file_path.is_file() or \
+                   file_path.stat().st_size != size:
+                    broken[chapter_id] = directory
+                    break
+
+        return broken
+
+    def drop_pages(self, chapter_ids: list[str]) -> None:
+        """Forget the pages of the chapters, sync fetches them again."""
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM pages WHERE chapter_id = ?",
+                                [(chapter_id,) for chapter_id in chapter_ids])
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
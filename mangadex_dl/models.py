@@ -0,0 +1,105 @@
+"""
+Mangadex-dl: models.py
+Records of manga and chapters parsed once from the API responses.
+"""
+
+import sys
+import math
+from dataclasses import dataclass, field
+
+# volumes named other than with a number, e.g. "Extra", go after the
+# numbered ones and before the unknown volume
+NAMED_VOLUME = sys.float_info.max
+
+
+@dataclass(slots=True)
+class Chapter:
+    id: str
+    manga_id: str | None
+    volume: str | None        # None if the volume is unknown
+    chapter: str | None       # None for oneshots
+    title: str
+    group_id: str | None
+    group_name: str | None    # None if the group wasn't included in the feed
+    pages: int
+    updated_at: str | None
+    external_url: str | None = None
+    volume_key: float = field(init=False, repr=False)
+    chapter_key: float = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # unknown volumes go after the numbered and named ones
+        self.volume_key = _get_number(self.volume, math.inf, NAMED_VOLUME)
+        self.chapter_key = _get_number(self.chapter, 0.0, math.inf)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Chapter":
+        attributes = data["attributes"]
+        manga_id = None
+        group = None
+
+        for relation in data["relationships"]:
+            if relation["type"] == "manga":
+                manga_id = relation["id"]
+            elif relation["type"] == "scanlation_group" and group is None:
+                group = relation
+
+        return cls(id=data["id"],
+                   manga_id=manga_id,
+                   volume=attributes["volume"],
+                   chapter=attributes["chapter"],
+                   title=attributes["title"] or "",
+                   group_id=group["id"] if group else None,
+                   group_name=group["attributes"]["name"]
+                   if group and "attributes" in group else None,
+                   pages=attributes.get("pages") or 0,
+                   updated_at=attributes.get("updatedAt"),
+                   external_url=attributes.get("externalUrl"))
+
+    @property
+    def volume_name(self) -> str:
+        return self.volume or "Unknown"
+
+    @property
+    def chapter_name(self) -> str:
+        return self.chapter or "Oneshot"
+
+    @property
+    def sort_key(self) -> tuple[float, float]:
+        return self.volume_key, self.chapter_key
+
+
+@dataclass(slots=True)
+class MangaTags:
+    format: list[str] = field(default_factory=list)
+    theme: list[str] = field(default_factory=list)
+    genre: list[str] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class MangaInfo:
+    uuid: str
+    title: str
+    title_en: str
+    authors: list[str]
+    artists: list[str]
+    year: int | None
+    status: str
+    last_volume: str | None
+    last_chapter: str | None
+    demographic: str | None
+    content_rating: str
+    tags: MangaTags
+    description: str
+    original_language: str
+    latest_chapter: str | None
+
+
+def _get_number(value: str | None, default: float, other: float) -> float:
+    """Volume or chapter number as float, 'other' if it isn't a number."""
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return other
@@ -4,115 +4,105 @@ Parse command-line user input for requested chapters and return a list of them.
 """
 
 import re
+import math
+from bisect import bisect_left, bisect_right
+
+RE_POINT = re.compile(r"v(?P<volume>u|\d+(?:\.\d+)?)"
+                      r"(?:\((?P<chapter>Oneshot|\d+(?:\.\d+)?)\))?")
+RE_LATEST = re.compile(r"latest\s*(?P<count>\d+)")
 
 def parse_range(range_input):
     """
     Parse user input in console mode.
     """
-    range_list = []
-
     if range_input == "all":
         return "all"
 
     # split the input string into separate ranges
-    # ["v1", "v2(1)-v6(8)", ...]
-    entry_input_list = range_input.split(",")
-
-    # define a start and end point for each range
-    for entry_input in entry_input_list:
-        range_object = _parse_entry_input(entry_input)
-        range_list.append(range_object)
-    return range_list
+    # ["v1", "v2(1)-v6(8)", "v9-", "latest 5", ...]
+    # empty entries, as after a trailing comma, are skipped
+    return [_parse_entry_input(entry_input.strip())
+            for entry_input in range_input.split(",")
+            if entry_input.strip()]
 
 def get_requested_chapters(chapters_list, dl_list):
+    """
+    Return the chapters of all ranges without repeats,
+    ordered by volume and chapter number.
+    """
     if dl_list == "all":
         return chapters_list
 
-    requested_chapters = []
+    # the index is sorted once, every range is found by bisection
+    index = sorted(chapters_list, key=lambda chapter: chapter.sort_key)
+    keys = [chapter.sort_key for chapter in index]
+
+    positions = set()
     for dl_range in dl_list:
-        requested_chapters += _get_chapters_from_range(chapters_list, dl_range)
+        positions.update(range(*_get_range_bounds(keys, dl_range)))
 
-    if len(requested_chapters) == 0:
+    if len(positions) == 0:
         raise ValueError("Empty list of chapters. "\
                          "Make sure you enter the correct download range!")
 
-    return requested_chapters
+    return [index[i] for i in sorted(positions)]
 
 def _parse_entry_input(entry_input):
-    range_object = {"start": {"volume": None, "chapter": None},
-                    "end": {"volume": None, "chapter": None}}
-
-    # "v1(1)-v2(3)" --> ["v1(1)", "v2(3)"]
-    entry_list = entry_input.split("-")
-    re_range = r"v(?P<volume>u|\d+)(?:\((?P<chapter>Oneshot|\d+.?(?:\d+)?)\))?"
-
-    # compose a range object from points
-    point = "start" # first write to range_object["start"]
-    for entry in entry_list:
-        if entry == "":
-            break
-        # parse volume number
-        entry_re = re.search(re_range, entry)
-        range_object[point]["volume"] = entry_re.group("volume")
-        range_object[point]["chapter"] = entry_re.group("chapter")
-
-        point = "end" # switch to range_object["end"]
-
-    # set end point
-    if not range_object["end"]["volume"]:
-        range_object["end"] = range_object["start"]
-    elif not range_object["end"]["chapter"]:
-        range_object["end"]["chapter"] = range_object["start"]["chapter"]
-
-    return range_object
-
-def _get_chapters_from_range(chapters_list, dl_range):
-    requested_chapters = []
-
-    is_in_range = False     # flag to add chapters
-
-    chapter_last = None     # flag to add last chapter
-    volume_last = None      # flag to add last volume
-
-    for chapter in chapters_list:
-        chapter_volume = chapter["attributes"]["volume"]
-        chapter_name   = chapter["attributes"]["chapter"] or "Oneshot"
-
-        # if it was the last volume or chapter
-        if (volume_last and chapter_volume != volume_last) or \
-           (chapter_last and chapter_name != chapter_last):
-            break
-
-        if not is_in_range:
-            # range start point check
-            # if current volume name matches start volume name
-            if (not chapter_volume and dl_range["start"]["volume"] == "u")\
-               or (chapter_volume == dl_range["start"]["volume"]):
-
-                # if the current chapter name is
-                # same as the target chapter name
-                # or if no target chapter is specified
-                if chapter_name == dl_range["start"]["chapter"]\
-                   or not dl_range["start"]["chapter"]:
-
-                    # mark this and subsequent chapters for addition
-                    is_in_range = True
-
-        if is_in_range:
-            # range end point check
-            # if the current volume name is same as the target volume name
-            # or if no target volume is specified
-            if (not chapter_volume and dl_range["end"]["volume"] == "u")\
-               or (chapter_volume == dl_range["end"]["volume"]):
-
-                # this volume is the last
-                volume_last = chapter_volume
-
-                # if the current chapter name
-                # same as the target chapter name
-                if chapter_name == dl_range["end"]["chapter"]:
-                    chapter_last = chapter_name
-
-            requested_chapters.append(chapter)
-
-    return requested_chapters
+    """
+    "v1(1)-v2(3)" --> {"start": point, "end": point}
+    "v5-"         --> {"start": point, "end": None}, up to the last chapter
+    "latest 10"   --> {"latest": 10}
+    Points are {"volume": "1" or "u", "chapter": "1", "Oneshot" or None}.
+    """
+    latest_re = RE_LATEST.fullmatch(entry_input)
+    if latest_re:
+        return {"latest": int(latest_re.group("count"))}
+
+    start_input, dash, end_input = entry_input.partition("-")
+
+    start = _parse_point(start_input)
+    if not dash:
+        end = start
+    elif not end_input:
+        end = None
+    else:
+        end = _parse_point(end_input)
+
+    return {"start": start, "end": end}
+
+def _parse_point(point_input):
+    point_re = RE_POINT.fullmatch(point_input.strip())
+    if not point_re:
+        raise ValueError(f"Invalid download range: '{point_input}'")
+
+    return {"volume": point_re.group("volume"),
+            "chapter": point_re.group("chapter")}
+
+def _get_range_bounds(keys, dl_range):
+    """Return the slice of the sorted keys covered by the range."""
+    if "latest" in dl_range:
+        return max(len(keys) - dl_range["latest"], 0), len(keys)
+
+    start = bisect_left(keys, _get_point_key(dl_range["start"], -math.inf))
+    if dl_range["end"] is None:
+        return start, len(keys)
+
+    # a volume without chapter ends after its last chapter
+    end = bisect_right(keys, _get_point_key(dl_range["end"], math.inf))
+    return start, end
+
+def _get_point_key(point, chapter_default):
+    """Same order as Chapter.sort_key, unknown volume is the last."""
+    if point["volume"] == "u":
+        volume_key = math.inf
+    else:
+        volume_key = float(point["volume"])
+
+    if point["chapter"] is None:
+        chapter_key = chapter_default
+    elif point["chapter"] == "Oneshot":
+        chapter_key = 0.0
+    else:
+        chapter_key = float(point["chapter"])
+
+    return volume_key, chapter_key
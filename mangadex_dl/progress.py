@@ -0,0 +1,203 @@
+"""
+Mangadex-dl: progress.py
+Progress of downloads and archiving. Worker threads only put events
+into a queue, the Tk main loop or the console renderer drains it
+a few times per second and shows the latest state.
+"""
+
+import time
+import queue
+import threading
+import contextlib
+import functools
+from collections import deque
+
+FRAME_RATE = 10    # redraws per second
+SPEED_WINDOW = 5   # seconds the download speed is averaged over
+
+
+class ProgressBus:
+    """
+    Queue of (kind, values) events, put() never blocks the worker and
+    stamps values["time"], since the events are applied later. Kinds:
+    "reset", "chapter", "unavailable", "page", "chapter_done", "archive",
+    "archived" (an archive made during the download), "status" and
+    "call" (a function for the GUI thread).
+    """
+
+    def __init__(self):
+        self.events = queue.SimpleQueue()
+
+    def put(self, kind, **values):
+        values["time"] = time.monotonic()
+        self.events.put((kind, values))
+
+    def call(self, function, *args, **kwargs):
+        """Run the function in the thread draining the bus."""
+        self.put("call", function=functools.partial(function, *args, **kwargs))
+
+    def drain(self):
+        """Return all events put so far."""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class ProgressState:
+    """Latest counters folded from the events, with speed and ETA."""
+
+    def __init__(self):
+        self.reset(time.monotonic())
+
+    def reset(self, started):
+        self.chapter = self.chapter_total = 0
+        self.page = self.page_total = 0
+        self.archived = self.archive_total = 0
+        self.size = 0
+        self.started = started
+        self.transfers = deque()  # (time, bytes) of the last pages
+
+    def apply(self, kind, values):
+        if kind == "reset":
+            self.reset(values["time"])
+        elif kind == "chapter":
+            self.chapter = values["count"]
+            self.chapter_total = values["total"]
+            self.page = self.page_total = 0
+        elif kind == "page":
+            self.page = values["count"]
+            self.page_total = values["total"]
+            if values["size"]:
+                self.size += values["size"]
+                self.transfers.append((values["time"], values["size"]))
+        elif kind == "chapter_done":
+            self.page = self.page_total = 0
+        elif kind == "archive":
+            self.archived = values["count"]
+            self.archive_total = values["total"]
+
+    def get_speed(self):
+        """Bytes per second over the last SPEED_WINDOW seconds."""
+        now = time.monotonic()
+        while self.transfers and self.transfers[0][0] < now - SPEED_WINDOW:
+            self.transfers.popleft()
+        seconds = min(SPEED_WINDOW, now - self.started)
+        if not self.transfers or seconds <= 0:
+            return 0
+        return sum(size for _, size in self.transfers) / seconds
+
+    def get_eta(self):
+        """Seconds left for the chapters or None if unknown yet."""
+        done = self.chapter - 1
+        if self.page_total:
+            done += self.page / self.page_total
+        if done <= 0 or not self.chapter_total:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (self.chapter_total - done) / done
+
+    def get_rate_text(self):
+        """"1.2 MiB/s, ETA 0:35" or an empty string."""
+        speed = self.get_speed()
+        eta = self.get_eta()
+        if not speed or eta is None:
+            return ""
+        return f"{format_size(speed)}/s, ETA {format_time(eta)}"
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+
+class ConsoleRenderer(threading.Thread):
+    """
+    Prints the events of the bus FRAME_RATE times per second.
+    Page events between two redraws are shown only once.
+    """
+
+    def __init__(self, bus):
+        super().__init__(daemon=True)
+        self.bus = bus
+        self.state = ProgressState()
+        self.stopped = threading.Event()
+        self.line_width = 0
+
+    def run(self):
+        while not self.stopped.wait(1 / FRAME_RATE):
+            self.render()
+        self.render()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def render(self):
+        is_page = False
+        for kind, values in self.bus.drain():
+            if is_page and kind != "page":
+                self.print_pages()
+                is_page = False
+
+            self.state.apply(kind, values)
+            if kind == "page":
+                is_page = True
+            elif kind == "chapter":
+                print("\nDownloading chapter [{:3}/{:3}] "
+                      "Ch.{} {}".format(values["count"], values["total"],
+                                        values["chapter"].chapter_name,
+                                        values["chapter"].title))
+                self.line_width = 0
+            elif kind == "unavailable":
+                print(f"  Chapter {values['chapter'].chapter_name} "
+                      "is not available on Mangadex.")
+            elif kind == "archive":
+                print(f"\r  Archiving [{values['count']:3}/"
+                      f"{values['total']:3}]...", end="", flush=True)
+            elif kind == "archived":
+                print(f"\n  Archived {values['name']}")
+            elif kind == "status":
+                print(values["text"])
+
+        if is_page:
+            self.print_pages()
+
+    def print_pages(self):
+        line = f"\r  Downloaded images [{self.state.page:3}/" \
+               f"{self.state.page_total:3}]... {self.state.get_rate_text()}"
+        # clear the rest of a longer previous line
+        self.line_width = max(self.line_width, len(line))
+        print(line.ljust(self.line_width), end="", flush=True)
+
+
+@contextlib.contextmanager
+def reporting(gui):
+    """
+    Yield the bus of the GUI, or a new bus printed
+    to the console while the block runs.
+    """
+    if gui.get("progress"):
+        yield gui["progress"]
+        return
+
+    bus = ProgressBus()
+    renderer = ConsoleRenderer(bus)
+    renderer.start()
+    try:
+        yield bus
+    finally:
+        renderer.stop()
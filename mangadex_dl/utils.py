@@ -5,11 +5,18 @@ Basic functions for getting information about manga;
 
 import re
 import logging
+import concurrent.futures
 from pathlib import Path
 from functools import lru_cache
-from collections import namedtuple
 
 import mangadex_dl.download as dl
+from mangadex_dl.models import Chapter, MangaInfo, MangaTags
+
+FEED_LIMIT = 500   # chapters per feed page, the API maximum
+FEED_WORKERS = 4   # feed pages requested at the same time
+SEARCH_WORKERS = 5 # search results resolved at the same time
+CHAPTER_LIMIT = 100 # chapters per /chapter page, the API maximum
+OFFSET_MAX = 10000  # the API doesn't page further
 
 
 def get_uuid(manga_url):
@@ -21,83 +28,195 @@ def get_uuid(manga_url):
 
 
 def search_manga(title, language):
-    res = dl.get_json("https://api.mangadex.org/manga", {"title": title})
+    """
+    Results are built from the search response itself. Persons missing
+    from it are requested concurrently for all results.
+    """
+    res = dl.get_json(f"{dl.API_URL}/manga",
+                      {"title": title, "includes[]": ["author", "artist"]})
 
-    return [get_manga_info(manga["id"], language) for manga in res["data"]]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=SEARCH_WORKERS) as executor:
+        return list(executor.map(_parse_manga_info, res["data"],
+                                 [language] * len(res["data"])))
 
 
 def get_manga_info(manga_url, language):
-    manga_info = namedtuple("manga_info", ["uuid", "title", "title_en",
-                                           "authors", "artists",
-                                           "year", "status",
-                                           "last_volume", "last_chapter",
-                                           "demographic", "content_rating",
-                                           "tags", "description",
-                                           "original_language"])
-    manga_info.uuid = get_uuid(manga_url)
-
-    res = dl.get_json(f"https://api.mangadex.org/manga/{manga_info.uuid}")
-
-    manga_info.year = res["data"]["attributes"]["year"]
-    manga_info.status = res["data"]["attributes"]["status"]
-    manga_info.last_volume = res["data"]["attributes"]["lastVolume"]
-    manga_info.last_chapter = res["data"]["attributes"]["lastChapter"]
-    manga_info.content_rating = res["data"]["attributes"]["contentRating"]
-    manga_info.original_language = res["data"]["attributes"]["originalLanguage"]
-    manga_info.demographic = res["data"]["attributes"]["publicationDemographic"]
-
-    manga_info.tags = _get_tags(res)
-    manga_info.description = _get_description(res, language)
-    manga_info.authors, manga_info.artists = _get_authors(res)
-    manga_info.title, manga_info.title_en = _get_title(res, language)
-
-    return manga_info
-
-
-def get_chapters_list(manga_uuid, language):
-    chapters_info = get_chapters_info(manga_uuid, language)
+    manga_uuid = get_uuid(manga_url)
+    res = dl.get_json(f"{dl.API_URL}/manga/{manga_uuid}",
+                      {"includes[]": ["author", "artist"]})
+
+    return _parse_manga_info(res["data"], language)
+
+
+def _parse_manga_info(data, language):
+    attributes = data["attributes"]
+    title, title_en = _get_title(data, language)
+    authors, artists = _get_authors(data)
+
+    return MangaInfo(uuid=data["id"],
+                     title=title,
+                     title_en=title_en,
+                     authors=authors,
+                     artists=artists,
+                     year=attributes["year"],
+                     status=attributes["status"],
+                     last_volume=attributes["lastVolume"],
+                     last_chapter=attributes["lastChapter"],
+                     demographic=attributes["publicationDemographic"],
+                     content_rating=attributes["contentRating"],
+                     tags=_get_tags(data),
+                     description=_get_description(data, language),
+                     original_language=attributes["originalLanguage"],
+                     latest_chapter=attributes.get("latestUploadedChapter"))
+
+
+def get_manga_list(manga_uuids, language):
+    """
+    Return manga info of many titles, 100 per request. It checks
+    the titles for updates, so it is never taken from the cache.
+    """
+    manga_list = []
+    for i in range(0, len(manga_uuids), 100):
+        res = dl.url_request(f"{dl.API_URL}/manga",
+                             {"ids[]": manga_uuids[i:i+100],
+                              "limit": 100,
+                              "includes[]": ["author", "artist"],
+                              "contentRating[]": ["safe", "suggestive",
+                                                  "erotica", "pornographic"]},
+                             json=True)
+        manga_list += [_parse_manga_info(data, language)
+                       for data in res["data"]]
+    return manga_list
+
+
+def get_updated_manga(sync_marks, language):
+    """
+    Return uuids of the titles with chapters created or re-uploaded
+    since their sync mark, 'sync_marks' is {manga uuid: updatedAt}.
+    The chapters of 100 titles are requested at once.
+    """
+    manga_uuids = list(sync_marks)
+    updated = set()
+
+    for i in range(0, len(manga_uuids), 100):
+        chunk = manga_uuids[i:i+100]
+        params = {"manga[]": chunk,
+                  "translatedLanguage[]": [language],
+                  "order[updatedAt]": "asc",
+                  "limit": CHAPTER_LIMIT,
+                  "contentRating[]": ["safe", "suggestive",
+                                      "erotica", "pornographic"],
+                  # "2024-01-01T00:00:00+00:00" -> "2024-01-01T00:00:00"
+                  "updatedAtSince": min(sync_marks[uuid]
+                                        for uuid in chunk)[:19]}
+        offset = 0
+        while True:
+            res = dl.url_request(f"{dl.API_URL}/chapter",
+                                 params | {"offset": offset}, json=True)
+            if res["total"] > OFFSET_MAX:
+                # too many to page through, sync them all
+                updated.update(chunk)
+                break
+
+            for chapter in map(Chapter.from_json, res["data"]):
+                sync_mark = sync_marks.get(chapter.manga_id)
+                if sync_mark and chapter.updated_at > sync_mark:
+                    updated.add(chapter.manga_id)
+
+            offset += CHAPTER_LIMIT
+            if offset >= res["total"]:
+                break
+
+    return updated
+
+
+def get_chapters_list(manga_uuid, language, updated_since=None,
+                      callback=None):
+    """
+    Return chapters of the manga feed as Chapter records.
+    With 'updated_since' (updatedAt of a chapter) only chapters created
+    or updated since then are returned, and an empty list is not an error.
+    callback(received, total) is called after every feed page.
+    """
     chapters_list = []
-    offset = 0
-
-    if chapters_info["total"] == 0:
-        raise ValueError("No chapters available to download!")
 
-    while offset < chapters_info["total"]:  # if more than 500 chapters!
-        res = dl.get_json(f"https://api.mangadex.org/manga/{manga_uuid}/feed"
-                          "?order[volume]=asc&order[chapter]=asc&limit=500"
-                          f"&translatedLanguage[]={language}&offset={offset}"
-                          "&contentRating[]=safe"
-                          "&contentRating[]=suggestive"
-                          "&contentRating[]=erotica"
-                          "&contentRating[]=pornographic")
-        chapters_list += res["data"]
-        offset += 500
+    for chapters_page, total in iter_chapters_pages(manga_uuid, language,
+                                                    updated_since):
+        chapters_list += map(Chapter.from_json, chapters_page)
+        if callback:
+            callback(len(chapters_list), total)
 
-    unavailable_list = []
+    if not chapters_list and not updated_since:
+        raise ValueError("No chapters available to download!")
 
-    for chapter in chapters_list:
-        if chapter["attributes"]["externalUrl"]:
-            unavailable_list.append(chapter)
+    unavailable_list = [chapter for chapter in chapters_list
+                        if chapter.external_url]
 
     if len(unavailable_list) != 0:
         s = f"{len(unavailable_list)} chapter(s) are not available:\n["
-        s += ", ".join(i["attributes"]["chapter"] for i in unavailable_list)
+        s += ", ".join(i.chapter_name for i in unavailable_list)
         s += "]"
         logging.warning(s)
 
-        for chapter in unavailable_list:
-            chapters_list.remove(chapter)
+        chapters_list = [chapter for chapter in chapters_list
+                         if not chapter.external_url]
 
     return chapters_list
 
 
-def get_chapters_info(manga_uuid, language):
-    return dl.get_json(f"https://api.mangadex.org/manga/{manga_uuid}/feed"
-                       f"?limit=0&translatedLanguage[]={language}"
+def iter_chapters_pages(manga_uuid, language, updated_since=None):
+    """
+    Yield (chapters JSON, total) for every page of the feed in order.
+    The first page tells the total, the other pages are then
+    requested concurrently within the rate limits.
+    """
+    res = _get_feed_page(manga_uuid, language, 0, updated_since)
+    total = res["total"]
+    yield res["data"], total
+
+    offsets = range(FEED_LIMIT, total, FEED_LIMIT)
+    if not offsets:
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=FEED_WORKERS) as executor:
+        future_list = [executor.submit(_get_feed_page, manga_uuid, language,
+                                       offset, updated_since)
+                       for offset in offsets]
+        try:
+            for future in future_list:
+                yield future.result()["data"], total
+        finally:
+            # the caller stopped reading or a page failed
+            for future in future_list:
+                future.cancel()
+
+
+def _get_feed_page(manga_uuid, language, offset, updated_since=None):
+    return dl.get_json(f"{dl.API_URL}/manga/{manga_uuid}/feed"
+                       "?order[volume]=asc&order[chapter]=asc"
+                       f"&limit={FEED_LIMIT}"
+                       f"&translatedLanguage[]={language}&offset={offset}"
                        "&contentRating[]=safe"
                        "&contentRating[]=suggestive"
                        "&contentRating[]=erotica"
-                       "&contentRating[]=pornographic")
+                       "&contentRating[]=pornographic"
+                       "&includes[]=scanlation_group"
+                       + _get_updated_since_param(updated_since))
+
+
+def get_latest_update(chapters_list):
+    """Return the newest updatedAt of the chapters or None."""
+    return max((chapter.updated_at for chapter in chapters_list
+                if chapter.updated_at), default=None)
+
+
+def _get_updated_since_param(updated_since):
+    if not updated_since:
+        return ""
+    # "2024-01-01T00:00:00+00:00" -> "2024-01-01T00:00:00"
+    return f"&updatedAtSince={updated_since[:19]}"
 
 
 def create_manga_directory(user_dir,
@@ -128,16 +247,16 @@ def check_output_directory(user_dir):
     return out_dir
 
 
-def _get_title(res, language):
-    title_dict = res["data"]["attributes"]["title"]
-    alt_title_dict = res["data"]["attributes"]["altTitles"]
+def _get_title(data, language):
+    title_dict = data["attributes"]["title"]
+    alt_title_dict = data["attributes"]["altTitles"]
 
     if "en" in title_dict:
         title_en = title_dict["en"]
     elif len(title_dict) != 0:
         title_en = next(iter(title_dict.values()))
     else:
-        title_en = res["data"]["id"]
+        title_en = data["id"]
     title = title_en
 
     if language in title_dict:
@@ -150,8 +269,8 @@ def _get_title(res, language):
     return title, title_en
 
 
-def _get_description(res, language):
-    desc_dict = res["data"]["attributes"]["description"]
+def _get_description(data, language):
+    desc_dict = data["attributes"]["description"]
     desc = "Description missing"
 
     if "en" in desc_dict:
@@ -162,13 +281,10 @@ def _get_description(res, language):
     return desc
 
 
-def _get_tags(res):
-    tags = namedtuple("manga_tags", ["format", "theme", "genre"])
-    tags.format = []
-    tags.theme = []
-    tags.genre = []
+def _get_tags(data):
+    tags = MangaTags()
 
-    for tag in res["data"]["attributes"]["tags"]:
+    for tag in data["attributes"]["tags"]:
         tag_group = tag["attributes"]["group"]
 
         if "en" in tag["attributes"]["name"]:
@@ -186,31 +302,29 @@ def _get_tags(res):
     return tags
 
 
-def _get_authors(res):
+def _get_authors(data):
     """
-    This function returns a maximum of 3 authors only.
-    Getting a big list from anthologies is too long.
+    Names come from the relationships expanded with includes[],
+    other persons are requested one by one.
     """
     authors = []
     artists = []
-    for relation in res["data"]["relationships"]:
+    for relation in data["relationships"]:
         if relation["type"] == "author":
-            if len(authors) < 3:
-                authors.append(_get_person_info(relation["id"]))
-            elif len(authors) == 3:
-                authors.append("and others...")
-            continue
-
-        if relation["type"] == "artist":
-            if len(artists) < 3:
-                artists.append(_get_person_info(relation["id"]))
-            elif len(authors) == 3:
-                artists.append("and others...")
+            authors.append(_get_person_name(relation))
+        elif relation["type"] == "artist":
+            artists.append(_get_person_name(relation))
 
     return authors, artists
 
 
+def _get_person_name(relation):
+    if "attributes" in relation:
+        return relation["attributes"]["name"]
+    return _get_person_info(relation["id"])
+
+
 @lru_cache(maxsize=16)
 def _get_person_info(person_id):
-    res = dl.get_json(f"https://api.mangadex.org/author/{person_id}")
+    res = dl.get_json(f"{dl.API_URL}/author/{person_id}")
     return res["data"]["attributes"]["name"]
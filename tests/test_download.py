@@ -0,0 +1,125 @@
+"""
+Both download engines against a local stand-in of the MangaDex API,
+pointed at by download.API_URL.
+"""
+
+import json
+import asyncio
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from mangadex_dl import download as dl  # noqa: E402
+from mangadex_dl.models import Chapter  # noqa: E402
+
+CHAPTER_ID = "a4e3bd7c-3d4b-4e02-9bfc-1b5b0c3a6c5d"
+CHAPTER_HASH = "3ed5ed7ba35891cc9902f94e8488a51a"
+PAGES = [b"first page", b"second page", b"third page"]
+PAGE_NAMES = [f"x{i}-{hashlib.sha256(data).hexdigest()}.png"
+              for i, data in enumerate(PAGES, start=1)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == f"/at-home/server/{CHAPTER_ID}":
+            self._send(json.dumps({
+                "result": "ok",
+                "baseUrl": self.server.url,
+                "chapter": {"hash": CHAPTER_HASH,
+                            "data": PAGE_NAMES,
+                            "dataSaver": PAGE_NAMES}
+            }).encode(), "application/json")
+            return
+
+        for name, data in zip(PAGE_NAMES, PAGES):
+            if self.path == f"/data/{CHAPTER_HASH}/{name}":
+                self._send(data, "image/png", {"X-Cache": "HIT"})
+                return
+
+        self.send_error(404)
+
+    def _send(self, body, content_type, headers={}):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(dl, "API_URL", server.url)
+    yield server.url
+    server.shutdown()
+    server.server_close()
+
+
+def _get_engine(name):
+    if name == "async":
+        pytest.importorskip("aiohttp")
+    return dl.get_engine(name)
+
+
+class _Writer:
+    """Page writer of a stream, keeps the pages in memory."""
+
+    def __init__(self):
+        self.pages = {}
+
+    def put(self, image_count, data):
+        self.pages[image_count] = data
+
+
+def _download_page(engine, url, writer):
+    if engine is dl:
+        return dl._download_page(url, writer, 1)
+
+    async def run():
+        import aiohttp
+        async with aiohttp.ClientSession() as session:
+            return await engine._download_page(session, url, writer, 1)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("engine_name", ["thread", "async"])
+def test_download_chapters(api, tmp_path, engine_name):
+    engine = _get_engine(engine_name)
+    chapter = Chapter(id=CHAPTER_ID, manga_id=None, volume="1", chapter="2",
+                      title="", group_id=None, group_name=None,
+                      pages=len(PAGES), updated_at=None)
+
+    directories = engine.download_chapters([chapter], tmp_path, False,
+                                           resume=False)
+
+    assert directories == [tmp_path / "Volume 1" / "Chapter 2"]
+    for image_count, data in enumerate(PAGES, start=1):
+        assert (directories[0] / f"{image_count:03d}.png").read_bytes() == data
+
+
+@pytest.mark.parametrize("engine_name", ["thread", "async"])
+def test_download_page_cached(api, engine_name):
+    engine = _get_engine(engine_name)
+    writer = _Writer()
+    url = f"{api}/data/{CHAPTER_HASH}/{PAGE_NAMES[0]}"
+
+    size, cached, checksum = _download_page(engine, url, writer)
+
+    assert writer.pages == {1: PAGES[0]}
+    assert size == len(PAGES[0])
+    assert cached
+    assert checksum == hashlib.sha256(PAGES[0]).hexdigest()